@@ -17,12 +17,19 @@
 # along with Flap.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+
 from flap import logger
 from flap.util import truncate
 from flap.util.path import Path
-from flap.latex.symbols import SymbolTable
+from flap.latex.lexer import TokenCache
+from flap.latex.symbols import Symbol, SymbolTable
 from flap.latex.macros.factory import MacroFactory
 from flap.latex.parser import Parser, Factory, Context
+from flap.snapshot import PreambleSnapshot, SnapshotUnavailable
 
 
 def log(invocation, message, **kwargs):
@@ -34,100 +41,512 @@ def log(invocation, message, **kwargs):
     logger.debug(" ".join(data))
 
 
+class Lookahead:
+    """
+    A cheap scan of LaTeX sources, which spots the files they will
+    likely include, regardless of the macros in use, so that these
+    files can be prefetched.
+    """
+
+    PATTERN = re.compile(r"\\(input|include|subfile|includegraphics)"
+                         r"\s*(?:\[[^\]]*\])?\s*\{([^{}]+)\}")
+
+    @classmethod
+    def targets(cls, text):
+        """The pairs (command, link) found in the given text"""
+        if not isinstance(text, str):
+            return []
+        return [(command, link.strip())
+                for command, link in cls.PATTERN.findall(text)
+                if link.strip()]
+
+
 class Settings:
+    """
+    What FLaP is asked to do, that is, which root LaTeX file to
+    flatten, into which output directory, and through which file
+    system and user interface. Settings hold no state about the
+    flattening itself, so they can be executed several times, possibly
+    at once from different threads.
+
+    In speculative mode, chapters loaded with \\include are parsed on
+    the workers, from a snapshot of the macros and characters in use.
+    If a chapter turns out to change that state, the whole project is
+    flattened again, sequentially.
+
+    Given a snapshot file, FLaP saves there the state reached at
+    \\begin{document}, and restores it on subsequent runs, as long as
+    the preamble and the files it reads do not change.
+
+    Given a token cache directory, FLaP keeps there the tokens of the
+    files it lexes, packed, and loads them back on subsequent runs, as
+    long as these files do not change.
+    """
 
-    def __init__(self, file_system, ui, root_tex_file, output):
+    def __init__(self, file_system, ui, root_tex_file, output,
+                 speculative=False, snapshot=None, token_cache=None):
         self._file_system = file_system
         self._display = ui
         self._root_tex_file = root_tex_file
         self._output = output
+        self._speculative = speculative
+        self._snapshot = snapshot
+        self._token_cache = token_cache
+
+    @property
+    def file_system(self):
+        return self._file_system
+
+    @property
+    def display(self):
+        return self._display
+
+    @property
+    def root_tex_file(self):
+        return Path.fromText(self._root_tex_file)
+
+    @property
+    def root_directory(self):
+        return self._file_system.open(self.root_tex_file).container()
+
+    @property
+    def read_root_tex(self):
+        return self._file_system.open(self.root_tex_file).content()
+
+    @property
+    def output_directory(self):
+        return Path.fromText(self._output)
+
+    @property
+    def flattened(self):
+        return self.output_directory / "merged.tex"
+
+    @property
+    def snapshot_file(self):
+        if self._snapshot is None:
+            return None
+        return Path.fromText(self._snapshot)
+
+    @property
+    def token_cache(self):
+        """The directory where lexed tokens are kept across runs, if
+        any, as a path of the operating system"""
+        return self._token_cache
+
+    def execute(self):
+        """
+        Flatten the project and return the run, which records what was
+        done.
+        """
+        run = Run(self, self._speculative)
+        try:
+            run.execute()
+        except SpeculationFailed as conflict:
+            logger.info("%s, flattening again sequentially", conflict)
+            run = Run(self)
+            run.execute()
+        return run
+
+
+class Run:
+    """
+    A single flattening of a project, which holds everything that
+    changes along the way (the character table, the graphics path,
+    the selected inclusions, etc.). Macros report to the run they are
+    created for.
+
+    Local packages and classes are rewritten by a pool of workers,
+    while the main document is being parsed. The run waits for them
+    all before it writes the flattened document. The modifications
+    are shown at the end, in the order a sequential run would show
+    them: those made in a dependency are journaled apart, and shown
+    right after the command that loads it.
+    """
+
+    WORKERS = 4
+
+    GRAPHICS_EXTENSIONS = ["pdf", "png", "jpeg", "jpg", "ps", "eps", "svg"]
+
+    def __init__(self, settings, speculative=False):
+        self._settings = settings
+        self._speculative = speculative
+        self._changes = 0
+        self._first_chapter = None
+        self._file_system = settings.file_system
+        self._display = settings.display
         self._count = 0
         self._selected_for_inclusion = []
+        self._graphic_paths = []
         self._graphic_directories = []
         self._analysed_dependencies = []
         self._character_table = SymbolTable.default()
+        self._tokens = TokenCache(settings.token_cache)
+        self._lock = Lock()
+        self._workers = ThreadPoolExecutor(max_workers=self.WORKERS)
+        self._pending = []
+        self._journal = []
+        self._current = local()
+        self._snapshot = None
+        self._preamble = None
+        self._root_text = None
 
     @property
-    def root_tex_file(self):
-        return Path.fromText(self._root_tex_file)
+    def count(self):
+        """The number of modifications made so far"""
+        return self._count
+
+    @property
+    def is_speculative(self):
+        return self._speculative
 
     @property
     def root_directory(self):
-        return self._file_system.open(self.root_tex_file).container()
+        return self._settings.root_directory
+
+    @property
+    def output_directory(self):
+        return self._settings.output_directory
 
     def record_graphic_path(self, paths, invocation):
         log(invocation,
             "Updating graphicpath to {paths:s}",
             paths=repr(paths))
         self._show_invocation(invocation)
+        self._use_graphic_paths(paths)
+        self._record_change()
+
+    def _use_graphic_paths(self, paths):
+        self._graphic_paths = list(paths)
         self._graphic_directories = \
             [self._file_system.open(self.root_directory._path / each)
              for each in paths]
 
     @property
     def graphics_directory(self):
+        directories = getattr(self._current, "graphics_directory", None)
+        if directories is not None:
+            return directories
         return self._graphic_directories \
             if self._graphic_directories else [self.root_directory]
 
-    @property
-    def read_root_tex(self):
-        return self._file_system.open(self.root_tex_file).content()
-
-    @property
-    def output_directory(self):
-        return Path.fromText(self._output)
+    def execute(self):
+        settings = self._settings
+        try:
+            text = settings.read_root_tex
+            self._prefetch_targets_of(text)
+            tokens = self._rewrite_root(
+                text, str(settings.root_tex_file.resource()))
+            self._wait_for_dependencies()
+        except SpeculationFailed:
+            raise
+        except Exception as error:
+            self._check_speculation(error)
+            self._show(self._journal)
+            raise
+        finally:
+            self._workers.shutdown()
+        self._save_snapshot()
+        self._show(self._journal)
+        self._write(tokens, settings.flattened)
+
+    def _check_speculation(self, error):
+        """
+        Raise SpeculationFailed if the given error, which stopped the
+        parsing of the main document, may come from the chapters parsed
+        speculatively: they are all awaited, and if any of them
+        conflicts, or if the settings changed since the first one was
+        submitted, the project must be flattened again sequentially.
+        """
+        if self._first_chapter is None:
+            return
+        conflict = None
+        while True:
+            with self._lock:
+                if not self._pending:
+                    break
+                pending = self._pending.pop(0)
+            try:
+                pending.result()
+            except SpeculationFailed as failure:
+                conflict = conflict or failure
+            except Exception:
+                pass
+        chapter, changes = self._first_chapter
+        if conflict is None and self._changes != changes:
+            conflict = SpeculationFailed(chapter)
+        if conflict is not None:
+            raise conflict from error
+
+    def _wait_for_dependencies(self):
+        """
+        Wait until all dependencies are rewritten, including those they
+        require in turn, and raise the first error, if any.
+        """
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                pending = self._pending.pop(0)
+            pending.result()
+
+    def _rewrite_root(self, text, source):
+        """
+        Rewrite the root document. Given a snapshot file, the state
+        reached at \\begin{document} is either restored from the
+        snapshot, and the preamble skipped, or captured while parsing,
+        and saved at the end of the run.
+        """
+        if self._settings.snapshot_file is None:
+            return self._rewrite(text, source)
+        factory = Factory(self._character_table, self._tokens)
+        scope = Context(definitions=MacroFactory(self).all())
+        snapshot = self._restore_snapshot(text, factory, scope)
+        if snapshot is not None:
+            body = factory.as_tokens(text, source)
+            body.skip(snapshot.end)
+            return [factory.as_raw_text(snapshot.rewriting, source)] \
+                + Parser(body, factory, scope).process()
+        self._snapshot = PreambleSnapshot()
+        self._preamble = self._snapshot
+        self._root_text = text
+        try:
+            return self._rewrite(text, source)
+        finally:
+            self._preamble = None
+
+    def begin_document(self, parser, invocation):
+        """
+        Capture the state reached at the given \\begin{document}, if a
+        snapshot is being taken, and if that command comes straight
+        from the root document, so that a later run can resume parsing
+        right after it.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.state is not None:
+            return
+        self._preamble = None
+        end = parser.offset_in(self._root_text)
+        if end is None \
+                or not self._root_text[:end].endswith(invocation.as_text):
+            logger.info("No preamble snapshot: \\begin{document} does not "
+                        "come straight from the root document")
+            self._snapshot = None
+            return
+        try:
+            snapshot.state = dict(
+                macros=[[each.name,
+                         PreambleSnapshot.encode(each._signature),
+                         PreambleSnapshot.encode(each._body)]
+                        for _, each in parser._definitions.items()
+                        if getattr(each, "is_user_defined", False)],
+                characters={each_category.value: list(each_characters)
+                            for each_category, each_characters
+                            in self._character_table.categories()},
+                graphics=self._graphic_paths,
+                selection=list(self._selected_for_inclusion),
+                dependencies=list(self._analysed_dependencies))
+        except SnapshotUnavailable as error:
+            logger.info("No preamble snapshot: %s", error)
+            self._snapshot = None
+            return
+        snapshot.ends_at(self._root_text, end)
+        snapshot.rewriting = parser.output_as_text() + invocation.as_text
+        snapshot.journal = list(self._journal)
+
+    def _save_snapshot(self):
+        """Save the snapshot taken during this run, once the
+        dependencies of the preamble are all rewritten"""
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.state is None:
+            return
+        self._file_system.create_file(self._settings.snapshot_file,
+                                      snapshot.save())
+
+    def _restore_snapshot(self, text, factory, scope):
+        """
+        Restore and return the snapshot saved by a previous run, if
+        any, and provided that it still holds. Otherwise, return None.
+        """
+        file = self._file_system.open(self._settings.snapshot_file)
+        try:
+            if file.is_missing():
+                return None
+            snapshot = PreambleSnapshot.load(file.content())
+        except OSError:
+            return None
+        if snapshot is None \
+                or not snapshot.holds(text, self._file_system):
+            return None
+        state = snapshot.state
+        for category, characters in state["characters"].items():
+            self._character_table[Symbol(int(category))] = characters
+        macros = MacroFactory(self)
+        for name, signature, body in state["macros"]:
+            scope.define(macros.create_user_defined(
+                name,
+                PreambleSnapshot.decode(signature, factory),
+                PreambleSnapshot.decode(body, factory)))
+        self._use_graphic_paths(state["graphics"])
+        self._selected_for_inclusion = list(state["selection"])
+        self._analysed_dependencies = list(state["dependencies"])
+        for name, content in snapshot.outputs.items():
+            self._file_system.create_file(self.output_directory / name,
+                                          content)
+        for name, path in snapshot.copies.items():
+            self._file_system.copy(
+                self._file_system.open(Path.fromText(path)),
+                self.output_directory / name)
+        self._journal.extend(snapshot.journal)
+        self._count += self._length_of(snapshot.journal)
+        logger.info("Preamble restored from '%s'",
+                    self._settings.snapshot_file)
+        return snapshot
+
+    def _length_of(self, journal):
+        return sum(self._length_of(each) if isinstance(each, list) else 1
+                   for each in journal)
 
     @property
-    def flattened(self):
-        return self.output_directory / "merged.tex"
-
-    def execute(self):
-        tokens = self._rewrite(self.read_root_tex,
-                               str(self.root_tex_file.resource()))
-        self._write(tokens, self.flattened)
+    def _current_preamble(self):
+        """The snapshot that records what the calling thread does, if
+        it works for the preamble, or None"""
+        return getattr(self._current, "preamble", self._preamble)
 
     def _rewrite(self, text, source, symbol_table=None):
         character_table = symbol_table or self._character_table
-        factory = Factory(character_table)
+        factory = Factory(character_table, self._tokens)
         macros = MacroFactory(self)
         parser = Parser(factory.as_tokens(text, source),
                         factory,
                         Context(definitions=macros.all()))
+        if text and not parser.needs_rewriting(text):
+            logger.debug("Nothing to rewrite in '%s'", source)
+            return [factory.as_raw_text(text, source)]
         return parser.process()
 
     def _write(self, tokens, destination):
         latex_code = "".join(str(each_token) for each_token in tokens)
         self._file_system.create_file(destination, latex_code)
+        return latex_code
 
     def end_of_input(self, source, invocation):
+        chapter = getattr(self._current, "chapter", None)
+        if chapter is not None:
+            raise SpeculationFailed(chapter)
         self._show_invocation(invocation)
         log(invocation, "Skipping the rest of '{source}'", source=source)
 
     def relocate_dependency(self, dependency, invocation):
-        if dependency not in self._analysed_dependencies:
-            self._analysed_dependencies.append(dependency)
-            try:
-                file = self._find(dependency,
-                                  [self.root_directory],
-                                  ["sty", "cls"],
-                                  TexFileNotFound(None))
-                new_path = file._path.relative_to(self.root_directory._path)
-                self._show_invocation(invocation)
-                symbol_table = self._character_table.clone()
-                symbol_table.CHARACTER += '@'
-                tokens = self._rewrite(file.content(),
-                                       file.fullname(),
-                                       symbol_table)
-                self._write(tokens,
-                            self.output_directory /
-                            self._as_file_name(new_path))
-                return self._as_file_name(new_path.without_extension())
-
-            except TexFileNotFound:
-                log(invocation,
-                    "Could not find class or package '{path:s}' locally",
-                    path=dependency)
+        with self._lock:
+            if dependency in self._analysed_dependencies:
                 return None
+            self._analysed_dependencies.append(dependency)
+        try:
+            file = self._find(dependency,
+                              [self.root_directory],
+                              ["sty", "cls"],
+                              TexFileNotFound(None))
+        except TexFileNotFound:
+            log(invocation,
+                "Could not find class or package '{path:s}' locally",
+                path=dependency)
+            return None
+        new_path = file._path.relative_to(self.root_directory._path)
+        self._show_invocation(invocation)
+        journal = []
+        self._current_journal.append(journal)
+        rewriting = self._workers.submit(self._rewrite_dependency,
+                                         file,
+                                         new_path,
+                                         self._character_table.clone(),
+                                         journal,
+                                         self._current_preamble)
+        with self._lock:
+            self._pending.append(rewriting)
+        return self._as_file_name(new_path.without_extension())
+
+    def speculate(self, link, invocation, parser):
+        """
+        In speculative mode, parse the given chapter on a worker, from a
+        snapshot of the given parser's definitions and characters, and
+        of the graphics path, and return the text that stands for its
+        rewriting, which is only awaited when written. Otherwise,
+        return None.
+        """
+        if not self._speculative:
+            return None
+        journal = []
+        self._current_journal.append(journal)
+        with self._lock:
+            changes = self._changes
+            if self._first_chapter is None:
+                self._first_chapter = (link, changes)
+        chapter = self._workers.submit(self._rewrite_chapter,
+                                       link,
+                                       invocation,
+                                       parser._definitions.snapshot(),
+                                       parser._create.symbols.clone(),
+                                       list(self.graphics_directory),
+                                       changes,
+                                       journal,
+                                       self._current_preamble)
+        with self._lock:
+            self._pending.append(chapter)
+        return parser._create.as_deferred_text(
+            lambda: "".join(map(str, chapter.result())),
+            invocation.location)
+
+    def _rewrite_chapter(self, link, invocation, definitions, symbols,
+                         graphics_directory, changes, journal, preamble):
+        self._current.journal = journal
+        self._current.preamble = preamble
+        self._current.graphics_directory = graphics_directory
+        self._current.chapter = link
+        try:
+            content = self.content_of(link, invocation)
+            factory = Factory(symbols, self._tokens)
+            scope = Context(definitions)
+            parser = Parser([], factory, scope)
+            tokens = Parser(factory.as_included(content, parser, link),
+                            factory,
+                            scope).process()
+        except Exception as error:
+            if self._changes != changes:
+                raise SpeculationFailed(link) from error
+            raise
+        finally:
+            del self._current.journal
+            del self._current.preamble
+            del self._current.graphics_directory
+            del self._current.chapter
+        if scope.available_macros or self._changes != changes:
+            raise SpeculationFailed(link)
+        return tokens
+
+    def _record_change(self):
+        """Record a change that chapters parsed in the meantime may
+        have missed"""
+        with self._lock:
+            self._changes += 1
+
+    def _rewrite_dependency(self, file, new_path, symbol_table, journal,
+                            preamble):
+        self._current.journal = journal
+        self._current.preamble = preamble
+        try:
+            symbol_table.assign("@", Symbol.CHARACTER.value)
+            content = file.content()
+            self._record_input(file, content)
+            tokens = self._rewrite(content,
+                                   file.fullname(),
+                                   symbol_table)
+            name = self._as_file_name(new_path)
+            latex_code = self._write(tokens, self.output_directory / name)
+            if preamble is not None:
+                preamble.wrote(name, latex_code)
+        finally:
+            del self._current.journal
+            del self._current.preamble
 
     def content_of(self, location, invocation):
         self._show_invocation(invocation)
@@ -138,13 +557,40 @@ class Settings:
         log(invocation,
             "Fetching content from '{file:s}'",
             file=file.fullname())
-        return file.content()
+        content = file.content()
+        self._record_input(file, content)
+        self._prefetch_targets_of(content)
+        return content
+
+    def _record_input(self, file, content):
+        preamble = self._current_preamble
+        if preamble is not None:
+            preamble.read(file.path(), content)
+
+    def _prefetch_targets_of(self, text):
+        """Prefetch the files that the given text will likely include"""
+        for command, link in Lookahead.targets(text):
+            if command == "includegraphics":
+                directories = self.graphics_directory
+                extensions = self.GRAPHICS_EXTENSIONS
+            else:
+                directories = [self.root_directory]
+                extensions = ["tex"]
+            path = Path.fromText(link)
+            for each_directory in directories:
+                location = each_directory._path / path
+                if path.has_extension():
+                    self._file_system.prefetch(location)
+                    continue
+                for each_extension in extensions:
+                    self._file_system.prefetch(
+                        Path.fromText(str(location) + "." + each_extension))
 
     def update_link_to_graphic(self, path, invocation, extra_folders=None):
-        extensions = ["pdf", "png", "jpeg", "jpg", "ps", "eps", "svg"]
+        extensions = self.GRAPHICS_EXTENSIONS
         searched_folders = self.graphics_directory
         if extra_folders:
-            searched_folders += \
+            searched_folders = searched_folders + \
                [self._file_system.open(self.root_directory._path / each)
                 for each in extra_folders]
         return self._update_link(path,
@@ -203,6 +649,9 @@ class Settings:
         new_path = file._path.relative_to(self.root_directory._path)
         new_file_name = self._as_file_name(new_path)
         self._file_system.copy(file, self.output_directory / new_file_name)
+        preamble = self._current_preamble
+        if preamble is not None:
+            preamble.copied(file.path(), new_file_name)
         log(invocation, "Copying '{source:s}' to '{target:s}'",
             source=file.fullname(), target=new_file_name)
         return new_path
@@ -221,6 +670,7 @@ class Settings:
             files=repr(selection))
         self._show_invocation(invocation)
         self._selected_for_inclusion.extend(selection)
+        self._record_change()
 
     def shall_include(self, link):
         if len(self._selected_for_inclusion) == 0:
@@ -229,11 +679,26 @@ class Settings:
             return link in self._selected_for_inclusion
 
     def _show_invocation(self, invocation):
-        self._count += 1
-        self._display.entry(file=invocation.location.source,
-                            line=invocation.location.line,
-                            column=invocation.location.column,
-                            code=invocation.as_text)
+        with self._lock:
+            self._count += 1
+        self._current_journal.append(
+            dict(file=invocation.location.source,
+                 line=invocation.location.line,
+                 column=invocation.location.column,
+                 code=invocation.as_text))
+
+    @property
+    def _current_journal(self):
+        """The journal of the dependency being rewritten by the calling
+        thread, if any, or the one of the main document"""
+        return getattr(self._current, "journal", self._journal)
+
+    def _show(self, journal):
+        for each_entry in journal:
+            if isinstance(each_entry, list):
+                self._show(each_entry)
+            else:
+                self._display.entry(**each_entry)
 
     def set_character_category(self, character, category):
         logger.debug("Set character {} in category '{}'"
@@ -251,6 +716,22 @@ class Settings:
         raise error
 
 
+class SpeculationFailed(Exception):
+    """
+    Exception thrown when a chapter parsed speculatively changes the
+    macros or the settings in use, misses such a change, or ends its
+    input early (i.e., with \\endinput)
+    """
+
+    def __init__(self, chapter):
+        super().__init__("Chapter '%s' changes the state" % chapter)
+        self._chapter = chapter
+
+    @property
+    def chapter(self):
+        return self._chapter
+
+
 class ResourceNotFound(Exception):
 
     def __init__(self, fragment):
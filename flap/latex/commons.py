@@ -22,20 +22,108 @@ from flap import logger
 
 
 class Context:
+    """
+    The macros (and parameters) in scope, indexed by name. Contexts are
+    nested, and each one only holds its own definitions.
+
+    Contexts that are open, that is the chain from the root to the
+    innermost scope, also share an index, which maps every name to the
+    open contexts that define it, from the outermost to the innermost.
+    Opening or closing a scope and looking up a symbol thus take
+    constant time, regardless of the nesting depth. Contexts that are
+    not open anymore resolve symbols through their parents.
+    """
 
     def __init__(self, parent=None, definitions=None):
-        self._definitions = definitions or dict()
+        self._definitions = dict()
         self._parent = parent
+        if parent is None:
+            self._depth = 0
+            self._open_scopes = [self]
+            self._owners = dict()
+        else:
+            self._depth = parent._depth + 1
+            self._open_scopes = parent._open_scopes
+            self._owners = parent._owners
+            parent._open()
+            self._open_scopes.append(self)
+        for name, value in (definitions or dict()).items():
+            self[name] = value
+
+    @property
+    def _is_open(self):
+        return self._depth < len(self._open_scopes) \
+            and self._open_scopes[self._depth] is self
+
+    def _open(self):
+        """Make this context the innermost open scope"""
+        if self._is_open:
+            self._close_nested_scopes()
+        else:
+            self._parent._open()
+            self._open_scopes.append(self)
+            for each_name in self._definitions:
+                self._owners.setdefault(each_name, []).append(self)
+
+    def _close_nested_scopes(self):
+        while len(self._open_scopes) > self._depth + 1:
+            self._open_scopes.pop()._withdraw()
+
+    def _withdraw(self):
+        for each_name in self._definitions:
+            owners = self._owners[each_name]
+            if owners[-1] is self:
+                owners.pop()
+            else:
+                owners.remove(self)
+
+    def close(self):
+        """Close this scope (and those nested in it) and return the
+        enclosing one"""
+        if self._is_open:
+            self._close_nested_scopes()
+            self._open_scopes.pop()._withdraw()
+        return self._parent
 
     def define(self, macro):
         logger.debug("Defining macro {}".format(macro.name))
-        self._definitions[macro.name] = macro
+        self[macro.name] = macro
 
     def look_up(self, symbol):
-        result = self._definitions.get(symbol, None)
-        if not result and self._parent:
-            return self._parent.look_up(symbol)
-        return result
+        scopes = self._open_scopes
+        if self._depth >= len(scopes) or scopes[self._depth] is not self:
+            return self._search(symbol)
+        owners = self._owners.get(symbol)
+        if owners:
+            if owners[-1]._depth <= self._depth:
+                return owners[-1]._definitions[symbol]
+            for each_owner in reversed(owners):
+                if each_owner._depth <= self._depth:
+                    return each_owner._definitions[symbol]
+        return None
+
+    def _search(self, symbol):
+        context = self
+        while context is not None:
+            if symbol in context._definitions:
+                return context._definitions[symbol]
+            context = context._parent
+        return None
+
+    def snapshot(self):
+        """
+        A new root context, which holds all the definitions visible from
+        this one, and which can thus be used independently.
+        """
+        chain = []
+        context = self
+        while context is not None:
+            chain.append(context)
+            context = context._parent
+        definitions = dict()
+        for each_context in reversed(chain):
+            definitions.update(each_context._definitions)
+        return Context(definitions=definitions)
 
     @property
     def available_macros(self):
@@ -45,17 +133,40 @@ class Context:
         return self._definitions.items()
 
     def __setitem__(self, key, value):
+        is_new = key not in self._definitions
         self._definitions[key] = value
+        if is_new and self._is_open:
+            owners = self._owners.setdefault(key, [])
+            index = len(owners)
+            while index > 0 and owners[index - 1]._depth > self._depth:
+                index -= 1
+            owners.insert(index, self)
 
     def __getitem__(self, key):
-        if self._parent and key not in self._definitions:
-            return self._parent[key]
-        else:
-            return self._definitions.get(key)
+        return self.look_up(key)
 
     def __contains__(self, key):
-        return key in self._definitions or (
-            self._parent and key in self._parent)
+        return self.look_up(key) is not None
+
+
+class Expansions:
+    """
+    Record, during a run, whether a macro that requires expansion
+    (e.g., \\input) was executed since the last check, so that macros
+    themselves do not hold any such state.
+    """
+
+    def __init__(self):
+        self._pending = False
+
+    def record(self, macro):
+        logger.debug("Expansion required by '%s'", macro.name)
+        self._pending = True
+
+    def check(self):
+        """True if an expansion was recorded since the last check"""
+        pending, self._pending = self._pending, False
+        return pending
 
 
 class Source:
@@ -105,6 +216,15 @@ class Stream:
     def is_empty(self):
         return self.look_ahead() is None
 
+    @property
+    def has_pending(self):
+        """True if items were looked ahead or pushed back"""
+        return len(self._cache) > 0
+
+    @property
+    def source(self):
+        return self._characters
+
     def _take(self):
         if self._cache:
             return self._cache.pop()
@@ -137,7 +257,7 @@ class Stream:
             assert items is not None, \
                 "Cannot push None"
             self._cache.append(items)
-        logger.debug(f"Pushing! New cache size: {str(len(self._cache))}")
+        # logger.debug(f"Pushing! New cache size: {len(self._cache)}")
         # self.debug()
 
     def debug(self):
@@ -148,6 +268,75 @@ class Stream:
             logger.debug(f"  - {index}: {item}")
 
 
+class TextMatcher:
+    """
+    Search a marker in a text fed piece by piece, using the
+    Knuth-Morris-Pratt automaton. It only keeps track of how much of
+    the marker the text read so far ends with, so that each character
+    is examined a constant number of times, and nothing is buffered.
+    """
+
+    def __init__(self, marker):
+        self._marker = marker
+        self._fallbacks = self._fallbacks_of(marker)
+        self._matched = 0
+
+    @staticmethod
+    def _fallbacks_of(marker):
+        fallbacks = [0] * len(marker)
+        matched = 0
+        for index in range(1, len(marker)):
+            while matched and marker[index] != marker[matched]:
+                matched = fallbacks[matched - 1]
+            if marker[index] == marker[matched]:
+                matched += 1
+            fallbacks[index] = matched
+        return fallbacks
+
+    @property
+    def is_idle(self):
+        """True if the text read so far ends with no part of the marker"""
+        return self._matched == 0
+
+    def skip(self, text):
+        """
+        Consume the given text at once, provided that no occurrence of
+        the marker ends within it. Return False, and consume nothing,
+        otherwise.
+        """
+        marker = self._marker
+        if marker in marker[:self._matched] + text:
+            return False
+        # Only the end of the text can start the next occurrence
+        tail = len(marker) - 1
+        if len(text) >= tail:
+            self._matched = 0
+            text = text[len(text) - tail:]
+        self.feed(text)
+        return True
+
+    def feed(self, text):
+        """
+        Consume the given text, and tell whether the whole text read so
+        far ends with the marker.
+        """
+        marker, fallbacks = self._marker, self._fallbacks
+        if not marker:
+            return True
+        matched = self._matched
+        found = False
+        for character in text:
+            while matched and character != marker[matched]:
+                matched = fallbacks[matched - 1]
+            if character == marker[matched]:
+                matched += 1
+            found = matched == len(marker)
+            if found:
+                matched = fallbacks[matched - 1]
+        self._matched = matched
+        return found
+
+
 class Position:
 
     UNKNOWN = "Unknown source file"
@@ -18,8 +18,87 @@
 #
 
 
-from flap.latex.commons import Stream, Position
+import os
+import re
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from flap.latex.commons import Position, Source
+from flap.latex.packing import InvalidPack, PackedTokens
+from flap.latex.symbols import Symbol
 from flap.latex.tokens import TokenFactory
+from flap.latex.vectorised import VectorisedLexer
+
+
+class ScanningRules:
+    """
+    How to scan a text under a given table of symbols: the category of
+    each special character, and the patterns that match text spans,
+    command names and comments. Rules are compiled once per distinct
+    table, and kept in a process-wide cache, which evicts the least
+    recently used ones.
+    """
+
+    CAPACITY = 16
+
+    _cache = OrderedDict()
+    _lock = Lock()
+
+    @classmethod
+    def of(cls, symbols):
+        fingerprint = symbols.fingerprint
+        with cls._lock:
+            rules = cls._cache.get(fingerprint)
+            if rules is not None:
+                cls._cache.move_to_end(fingerprint)
+                return rules
+        rules = ScanningRules(symbols)
+        with cls._lock:
+            cls._cache[fingerprint] = rules
+            while len(cls._cache) > cls.CAPACITY:
+                cls._cache.popitem(last=False)
+        return rules
+
+    @classmethod
+    def cached(cls):
+        with cls._lock:
+            return len(cls._cache)
+
+    def __init__(self, symbols):
+        self.categories = dict()
+        for each_category, each_characters \
+                in reversed(symbols.categories()):
+            for each_character in each_characters:
+                self.categories[each_character] = each_category
+        self.letters = frozenset(symbols.CHARACTER)
+        self.blanks = "".join(symbols.WHITE_SPACES)
+        self.new_lines = tuple(symbols.NEW_LINE)
+        self.text = self._compile(
+            self._none_of(symbols.special_characters()) + "+")
+        self.name = self._compile(self._any_of(symbols.CHARACTER) + "+")
+        self.comment = self._compile(
+            self._none_of(symbols.NEW_LINE) + "*")
+
+    @staticmethod
+    def _any_of(characters):
+        if not characters:
+            return "(?!)"
+        return "[" + "".join(map(re.escape, characters)) + "]"
+
+    @staticmethod
+    def _none_of(characters):
+        if not characters:
+            return "."
+        return "[^" + "".join(map(re.escape, characters)) + "]"
+
+    @staticmethod
+    def _compile(pattern):
+        return re.compile(pattern, re.DOTALL)
+
+    def category_of(self, character):
+        return self.categories.get(character, Symbol.OTHERS)
 
 
 class Lexer:
@@ -28,35 +107,107 @@ class Lexer:
     shall define handler for each category of symbols.  These handlers
     are automatically selected using reflection: each handler shall be
     named "_read_category".
+
+    Runs of letters, blanks and other characters (e.g., digits or
+    punctuation) are returned as a single text span, since they do not
+    contain anything FLaP would rewrite.
+
+    The lexer scans according to the rules compiled for its symbol
+    table, and looks them up again whenever that table changes.
     """
 
+    @staticmethod
+    def tokens_of(symbols, source):
+        """
+        All the tokens of the given source, at once. Very large sources
+        are lexed by the vectorised lexer, provided NumPy is installed.
+        """
+        if VectorisedLexer.applies_to(symbols, source):
+            return VectorisedLexer(symbols, source).tokens()
+        return list(Lexer(symbols, source))
+
     def __init__(self, symbols, source):
         self._source = source
         self._symbols = symbols
         self._tokens = TokenFactory(self._symbols)
+        self._version = None
+        self._scanning_rules = None
         self._reset()
 
-    def _reset(self):
-        self._position = Position(1, 0, self._source.name)
-        self._input = Stream(iter(self._source.content), self._on_take)
+    @property
+    def _rules(self):
+        if self._version != self._symbols.version:
+            self._scanning_rules = ScanningRules.of(self._symbols)
+            self._version = self._symbols.version
+        return self._scanning_rules
 
-    def _on_take(self, character):
-        # logger.debug("Lexer: " + character)
-        if character in self._symbols.NEW_LINE:
-            self._position = self._position.next_line()
-        else:
-            self._position = self._position.next_character()
+    def _reset(self):
+        self._text = self._source.content
+        self._index = 0
+        self._line = 1
+        self._column = 0
 
     @property
     def position(self):
-        return self._position
+        return Position(self._line, self._column, self._source.name)
+
+    @property
+    def offset(self):
+        """The number of characters scanned so far"""
+        return self._index
+
+    def reads(self, text):
+        """True if this lexer scans the given text"""
+        return self._text is text
 
     def _take(self):
-        return self._input.take()
+        if self._index >= len(self._text):
+            return None
+        character = self._text[self._index]
+        self._index += 1
+        if character in self._rules.new_lines:
+            self._line += 1
+            self._column = 0
+        else:
+            self._column += 1
+        return character
 
     @property
     def _next(self):
-        return self._input.look_ahead()
+        if self._index < len(self._text):
+            return self._text[self._index]
+        return None
+
+    def take_until(self, marker):
+        """
+        Skip the source text up to the given marker (or up to the end,
+        if the marker is missing), without lexing it, and return it.
+        """
+        end = self._text.find(marker, self._index)
+        if end < 0:
+            end = len(self._text)
+        return self._move_to(end)
+
+    def skip(self, length):
+        """
+        Skip the given number of characters, without lexing them, and
+        return them.
+        """
+        return self._move_to(min(self._index + length, len(self._text)))
+
+    def _move_to(self, end):
+        """Skip the text up to the given index, and return it"""
+        text = self._text[self._index:end]
+        new_lines = self._rules.new_lines
+        last_line_break = max((text.rfind(each) for each in new_lines),
+                              default=-1)
+        if last_line_break < 0:
+            self._column += len(text)
+        else:
+            self._line += sum(text.count(each) for each in new_lines)
+            self._column = len(text) - last_line_break - 1
+        self._index = end
+        return text
 
     def __iter__(self):
         return self
@@ -67,7 +218,7 @@ class Lexer:
         return self._one_token()
 
     def _one_token(self):
-        handler = self._handler_for(self._symbols.category_of(self._next))
+        handler = self._handler_for(self._rules.category_of(self._next))
         return handler()
 
     def _handler_for(self, category):
@@ -78,86 +229,159 @@ class Lexer:
         return handler
 
     def _read_character(self):
-        character = self._take()
-        return self._tokens.character(self._position, character)
+        return self._read_text()
+
+    def _read_text(self):
+        rules = self._rules
+        end = rules.text.match(self._text, self._index).end()
+        text = self._text[self._index:end]
+        location = Position(self._line, self._column + 1, self._source.name)
+        self._index = end
+        self._column += len(text)
+        if not text.strip(rules.blanks):
+            return self._tokens.white_space(location, text)
+        if len(text) == 1:
+            if text in rules.letters:
+                return self._tokens.character(location, text)
+            return self._tokens.others(location, text)
+        return self._tokens.text(location, text)
 
     def _read_control(self):
         marker = self._take()
-        location = self._position
+        location = self.position
         assert marker in self._symbols.CONTROL
-        if self._next not in self._symbols.CHARACTER:
+        match = self._rules.name.match(self._text, self._index)
+        if match is None:
             name = self._take()
         else:
-            name = self._take_while(lambda c: c in self._symbols.CHARACTER)
+            name = self._move_to(match.end())
         return self._tokens.command(location, marker + name)
 
     def _take_while(self, predicate):
-        return "".join(self._input.take_while(predicate))
+        start = self._index
+        while self._next is not None and predicate(self._next):
+            self._take()
+        return self._text[start:self._index]
 
     def _read_comment(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.COMMENT
-        text = self._take_while(lambda c: c not in self._symbols.NEW_LINE)
+        text = self._move_to(
+            self._rules.comment.match(self._text, self._index).end())
         return self._tokens.comment(location, marker + text)
 
     def _read_white_spaces(self):
-        marker = self._input.take()
-        location = self._position
-        spaces = self._take_while(lambda c: c in self._symbols.WHITE_SPACES)
-        return self._tokens.white_space(location, marker + spaces)
+        return self._read_text()
 
     def _read_new_line(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.NEW_LINE
         return self._tokens.new_line(location, marker)
 
     def _read_begin_group(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.BEGIN_GROUP
         return self._tokens.begin_group(location, marker)
 
     def _read_end_group(self):
         marker = self._take()
-        location = self._position
+        location = self.position
         assert marker in self._symbols.END_GROUP
         return self._tokens.end_group(location, marker)
 
     def _read_parameter(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.PARAMETER
         text = marker + self._take_while(lambda c: c.isdigit())
         return self._tokens.parameter(location, text)
 
     def _read_math(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.MATH
         return self._tokens.math(location)
 
     def _read_superscript(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.SUPERSCRIPT
         return self._tokens.superscript(location, marker)
 
     def _read_subscript(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.SUBSCRIPT
         return self._tokens.subscript(location, marker)
 
     def _read_non_breaking_space(self):
-        marker = self._input.take()
-        location = self._position
+        marker = self._take()
+        location = self.position
         assert marker in self._symbols.NON_BREAKING_SPACE
         return self._tokens.non_breaking_space(location, marker)
 
     def _read_others(self):
-        marker = self._input.take()
-        location = self._position
-        # assert marker in self._symbols.OTHERS
-        return self._tokens.others(location, marker)
+        return self._read_text()
+
+
+class TokenCache:
+    """
+    The tokens of the files already lexed, indexed by file name,
+    content hash and fingerprint of the symbol table, so that a file
+    included several times is lexed only once. Tokens are kept as
+    tuples, and each inclusion gets a list of its own.
+
+    Given a directory, which is created if need be, the cache also
+    packs the tokens it lexes into files, which it loads back in later
+    runs, as long as the content of the file is the same.
+    """
+
+    def __init__(self, directory=None):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self._entries = dict()
+        self._directory = directory
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def tokens_of(self, name, content, symbols):
+        key = (name, hash(content), symbols.fingerprint)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == content:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+        tokens = tuple(self._lex(name, content, symbols))
+        with self._lock:
+            self._entries[key] = (content, tokens)
+        return list(tokens)
+
+    def _lex(self, name, content, symbols):
+        if self._directory is None:
+            return Lexer.tokens_of(symbols, Source.anonymous(content))
+        path = self._pack_of(name, symbols)
+        try:
+            tokens = PackedTokens.load(path, content, symbols)
+            with self._lock:
+                self.loads += 1
+            return tokens
+        except (OSError, InvalidPack):
+            pass
+        source = Source.anonymous(content)
+        tokens = Lexer.tokens_of(symbols, source)
+        try:
+            PackedTokens.save(path, tokens, content, source.name)
+        except (OSError, InvalidPack):
+            pass
+        return tokens
+
+    def _pack_of(self, name, symbols):
+        key = sha256("{}\n{}".format(name, symbols.fingerprint)
+                     .encode("utf-8")).hexdigest()
+        return os.path.join(self._directory, key + ".tok")
@@ -18,6 +18,7 @@
 #
 
 from copy import copy
+from itertools import chain
 
 from flap import logger
 from flap.latex.errors import UnknownSymbol
@@ -30,29 +31,20 @@ class Macro:
     should replace it.
     """
 
+    requires_expansion = False
+
     def __init__(self, flap, name, signature, body):
         self._flap = flap
         self._name = name if not name.startswith("\\") else name[1:]
         self._signature = signature or []
         self._body = body or iter([])
-        self._called = False
-        self._requires_expansion = False
         self.is_user_defined = False
 
-    @property
-    def requires_expansion(self):
-        return self._requires_expansion
-
-    @property
-    def was_called(self):
-        return self._called
-
     @property
     def name(self):
         return self._name
 
     def execute2(self, parser, invocation):
-        self._called = True
         pass
 
     def rewrite2(self, parser, invocation):
@@ -111,10 +103,94 @@ class Macro:
 
 
 class UserDefinedMacro(Macro):
+    r"""
+    A macro defined in the LaTeX sources, using \def for instance. Its
+    body is analysed once, when it is defined: if it contains no
+    command, expanding it only means substituting its parameters, and
+    the body is kept as a list of segments, which are either the
+    tokens between two parameters (without groups), or the name of a
+    parameter.
+
+    Expanding an inert macro on plain arguments (without command nor
+    parameter) always gives the same tokens, which are thus memoised,
+    by argument texts. Redefining the macro creates a new instance,
+    with an empty memo.
+    """
 
     def __init__(self, flap, name, signature, body):
         super().__init__(flap, name, signature, body)
         self.is_user_defined = True
+        self._segments = self._compile(self._body)
+        self._expansions = dict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _compile(body):
+        if any(each_token.is_a_command for each_token in body):
+            return None
+        segments = [[]]
+        for each_token in body:
+            if each_token.is_a_parameter:
+                segments.append(str(each_token))
+                segments.append([])
+            elif not (each_token.begins_a_group or each_token.ends_a_group):
+                segments[-1].append(each_token)
+        return segments
+
+    @property
+    def is_inert(self):
+        """True if the body contains no command, which FLaP could
+        rewrite or execute"""
+        return self._segments is not None
+
+    def expansion_key(self, invocation):
+        """
+        The key of the given invocation in the memo, or None if its
+        expansion cannot be memoised.
+        """
+        if not self.is_inert:
+            return None
+        key = []
+        for each_argument in invocation.arguments.values():
+            if any(each_token.is_a_command or each_token.is_a_parameter
+                   for each_token in each_argument):
+                return None
+            key.append("".join(map(str, each_argument)))
+        return tuple(key)
+
+    def memoised_expansion(self, key):
+        """The expansion memoised under the given key, if any"""
+        if key is None:
+            return None
+        expansion = self._expansions.get(key)
+        if expansion is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return expansion
+
+    def memoise(self, key, expansion):
+        if key is not None:
+            self._expansions[key] = expansion
+
+    def expand_with(self, interpreter):
+        """
+        Substitute the parameters, as bound in the given interpreter,
+        into an inert body.
+        """
+        assert self.is_inert, "Only inert macros can be expanded directly"
+        output = []
+        for each_segment in self._segments:
+            if isinstance(each_segment, str):
+                tokens = interpreter.look_up(each_segment)
+                if tokens is None:
+                    raise RuntimeError(
+                        f"Undefined symbol '{each_segment}'")
+                output += interpreter.evaluate(tokens)
+            else:
+                output += each_segment
+        return output
 
 
 class UpdateLink(Macro):
@@ -168,19 +244,37 @@ class Invocation:
     """ The invocation of a LaTeX command, including the name of the
     command, and its parameters indexed by name as sequences of
     tokens.
+
+    Its text and its tokens are computed once, when first needed, and
+    forgotten only when the invocation changes.
     """
 
     def __init__(self, command):
-        self.name = command
+        self._name = command
         self._arguments = []
         self._keys = dict()
+        self._text = None
+        self._tokens = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, command):
+        self._name = command
+        self._forget_views()
+
+    def _forget_views(self):
+        self._text = None
+        self._tokens = None
 
     @property
     def as_text(self):
-        text = self.to_text(self.name)
-        for each_argument in self._arguments:
-            text += "".join(map(str, each_argument))
-        return text
+        if self._text is None:
+            self._text = self.to_text(self._name) \
+                + "".join(map(str, chain.from_iterable(self._arguments)))
+        return self._text
 
     @staticmethod
     def to_text(parameter):
@@ -203,9 +297,10 @@ class Invocation:
 
     def append(self, tokens):
         self._arguments.append(tokens)
+        self._forget_views()
 
     def append_argument(self, name, value):
-        self._arguments.append(value)
+        self.append(value)
         self._keys[name] = len(self._arguments) - 1
 
     def argument(self, key):
@@ -226,17 +321,23 @@ class Invocation:
         return {key: self._arguments[value]
                 for (key, value) in self._keys.items()}
 
-
     @property
     def as_tokens(self):
-        start = copy(self.name) \
-            if isinstance(self.name, list) \
-            else [self.name]
-        return sum(self._arguments, start)
+        """
+        All the tokens, from the command name to the last argument, in
+        a single list, which is shared and must not be modified.
+        """
+        if self._tokens is None:
+            tokens = copy(self._name) \
+                if isinstance(self._name, list) \
+                else [self._name]
+            for each_argument in self._arguments:
+                tokens.extend(each_argument)
+            self._tokens = tokens
+        return self._tokens
 
     def substitute(self, argument, value):
-        clone = Invocation(self.name)
-        clone.name = copy(self.name)
+        clone = Invocation(copy(self._name))
         clone._arguments = copy(self._arguments)
         clone._keys = copy(self._keys)
         clone._arguments[clone._keys[argument]] = value
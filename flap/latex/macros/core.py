@@ -64,12 +64,20 @@ class Def(Macro):
         body = invocation.argument("body")
         macro = UserDefinedMacro(
             self._flap,
-            "".join(map(str, invocation.argument("name"))),
+            self._name_of(invocation),
             invocation.argument("signature"),
             body)
         parser.define(macro)
 
+    @staticmethod
+    def _name_of(invocation):
+        return "".join(map(str, invocation.argument("name")))
+
     def rewrite2(self, parser, invocation):
+        macro = parser.look_up(self._name_of(invocation)[1:])
+        if macro is not None and macro.is_inert:
+            return invocation.as_tokens
+
         body = invocation.argument("body")
         try:
             rewritten_body = parser.rewrite(body, dict())
@@ -110,9 +118,17 @@ class Begin(Macro):
     def rewrite2(self, parser, invocation):
         environment = parser.find_environment(invocation)
         if environment is None:
+            if self._name_of(invocation) == "document":
+                self._flap.begin_document(parser, invocation)
             return invocation.as_tokens
         return environment.rewrite2(parser, invocation)
 
+    @staticmethod
+    def _name_of(invocation):
+        return "".join(each_token.as_text
+                       for each_token
+                       in invocation.argument("environment")[1:-1])
+
 
 class DocumentClass(Macro):
     """
@@ -142,9 +158,19 @@ class DocumentClass(Macro):
             document = parser.read.until_text(r"\end{document}", True)
             logger.debug("Subfile extraction" +
                          "".join(str(t) for t in document))
-            return parser.evaluate(document[:-11], dict())
+            return parser.evaluate(
+                self._without_marker(document, r"\end{document}"), dict())
         return invocation.as_tokens
 
+    @staticmethod
+    def _without_marker(tokens, marker):
+        """Drop the tokens that make the given marker, at the end"""
+        end, length = len(tokens), 0
+        while end > 0 and length < len(marker):
+            end -= 1
+            length += len(str(tokens[end]))
+        return tokens[:end]
+
 
 class PackageReference(Macro):
     """Abstract commands that load a package, either locally or from
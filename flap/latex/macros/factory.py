@@ -27,7 +27,7 @@ from flap.latex.macros.bibliography import Bibliography, \
     BibliographyStyle, MakeIndex
 from flap.latex.macros.inlining import EndInput, Include, IncludeOnly, \
     Input, SubFile
-from flap.latex.macros.listings import Verbatim
+from flap.latex.macros.listings import RawEnvironment
 from flap.latex.macros.biblatex import AddBibResource
 
 
@@ -36,6 +36,9 @@ class MacroFactory:
     Create macros that are associated with a given FLaP backend
     """
 
+    RAW_ENVIRONMENTS = ["comment", "lstlisting", "minted", "verbatim",
+                        "Verbatim"]
+
     def __init__(self, flap):
         self._flap = flap
         self._macros = [
@@ -59,9 +62,16 @@ class MacroFactory:
             SubFile(self._flap)
         ]
         self._environments = [
-            Overpic(flap),
-            Verbatim(flap)
+            Overpic(flap)
         ]
+        for each_name in self.RAW_ENVIRONMENTS:
+            self.declare_raw_environment(each_name)
+
+    def declare_raw_environment(self, name):
+        """
+        Declare an environment whose content must be copied as is
+        """
+        self._environments.append(RawEnvironment(self._flap, name))
 
     def all(self):
         definitions = {}
@@ -23,23 +23,20 @@ from flap.latex.macros.commons import Macro
 
 class TexFileInclusion(Macro):
 
+    requires_expansion = True
+
     def __init__(self, flap, name):
         super().__init__(flap, name, None, None)
-        self._requires_expansion = True
 
     def _capture_arguments(self, parser, invocation):
         invocation.append_argument("link", parser.read.one())
 
     def execute2(self, parser, invocation):
-        self._called = True
-        logger.debug("Setting CALLED on %d", id(self))
         link = parser.evaluate_as_text(invocation.argument("link"))
         content = self._flap.content_of(link, invocation)
         logger.debug("TEX INCLUSION %s: '%s'", link, content)
-        if not link.endswith(".tex"):
-            link += ".tex"
-        tokens = parser._create.as_list(content)
-        return parser._tokens.push(tokens)
+        return parser._tokens.push(
+            parser._create.as_included(content, parser, link))
 
     def rewrite2(self, parser, invocation):
         return []
@@ -63,12 +60,16 @@ class Include(TexFileInclusion):
         super().__init__(flap, "include")
 
     def execute2(self, parser, invocation):
-        self._called = True
         link = parser.evaluate_as_text(invocation.argument("link"))
         if self._flap.shall_include(link):
             tokens = parser._create.as_list(r"\clearpage")
             parser._tokens.push(tokens)
-            super().execute2(parser, invocation)
+            chapter = self._flap.speculate(link, invocation, parser) \
+                if parser.rewrites else None
+            if chapter is None:
+                super().execute2(parser, invocation)
+            else:
+                parser._tokens.push([chapter])
 
     def rewrite2(self, parser, invocation):
         return []
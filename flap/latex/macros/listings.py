@@ -20,17 +20,19 @@
 from flap.latex.macros.commons import Environment
 
 
-class Verbatim(Environment):
+class RawEnvironment(Environment):
     """
-    Intercept the \begin{verbatim} environment
+    Intercept environments whose content LaTeX reads verbatim, such as
+    \begin{verbatim} or \begin{lstlisting}. Their content is copied as
+    is, without being lexed.
     """
 
-    def __init__(self, flap):
-        super().__init__(flap, "verbatim")
-        self._content = None
+    def __init__(self, flap, name):
+        super().__init__(flap, name)
 
     def execute2(self, parser, invocation):
-        self._content = parser.read.until_text(r"\end{verbatim}")
+        content = parser.read.raw_until(r"\end{%s}" % self.name)
+        invocation.append_argument("content", content)
 
     def rewrite2(self, parser, invocation):
-        return parser._create.as_list(r"\begin{verbatim}") + self._content
+        return invocation.as_tokens
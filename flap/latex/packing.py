@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+
+from flap.latex.commons import Position
+from flap.latex.symbols import Symbol
+from flap.latex.tokens import TextSpan, Token
+
+
+class InvalidPack(ValueError):
+    """
+    Exception thrown when packed tokens cannot be read, or were not
+    lexed from the given source text
+    """
+
+
+class PackedTokens:
+    """
+    A compact binary form of the tokens lexed from a source text, which
+    does not hold their text, but only their category and length, as
+    the source they cover is given when unpacking. Positions are
+    stored as the differences between the line and column of two
+    consecutive tokens.
+
+    A pack starts with a header (magic number, version, byte order,
+    number of tokens, digest of the source and name of the source),
+    followed by four arrays: categories, lengths, line offsets and
+    column offsets. Each array uses the narrowest integer type that
+    fits its values, and is aligned on 4 bytes, so that unpacking
+    merely casts the buffer (e.g., a memory-mapped file) into arrays.
+    """
+
+    MAGIC = b"FLTK"
+    VERSION = 1
+    HEADER = struct.Struct("<4sBBxxII32s")
+    ARRAY = struct.Struct("<cxxxI")
+    ALIGNMENT = 4
+
+    UNSIGNED = "BHI"
+    SIGNED = "bhi"
+
+    BYTE_ORDERS = {"little": 0, "big": 1}
+
+    @classmethod
+    def pack(cls, tokens, text, name):
+        """
+        The given tokens, lexed from the given text, as bytes. Tokens
+        must cover the text, one after the other.
+        """
+        categories, lengths, lines, columns = [], [], [], []
+        line, column, offset = 1, 0, 0
+        for each_token in tokens:
+            token_text = each_token.as_text
+            if text[offset:offset + len(token_text)] != token_text:
+                raise InvalidPack(
+                    "Token %s does not cover the text at %d"
+                    % (repr(each_token), offset))
+            location = each_token.location
+            categories.append(each_token._category.value)
+            lengths.append(len(token_text))
+            lines.append(location.line - line)
+            columns.append(location.column - column)
+            line, column = location.line, location.column
+            offset += len(token_text)
+        if offset != len(text):
+            raise InvalidPack("Tokens do not cover the whole text")
+        encoded_name = name.encode("utf-8")
+        chunks = [cls.HEADER.pack(cls.MAGIC,
+                                  cls.VERSION,
+                                  cls.BYTE_ORDERS[sys.byteorder],
+                                  len(categories),
+                                  len(encoded_name),
+                                  cls._digest_of(text)),
+                  cls._padded(encoded_name)]
+        for values, typecodes in ((categories, "B"),
+                                  (lengths, cls.UNSIGNED),
+                                  (lines, cls.SIGNED),
+                                  (columns, cls.SIGNED)):
+            chunks.append(cls._pack_array(values, typecodes))
+        return b"".join(chunks)
+
+    @classmethod
+    def _pack_array(cls, values, typecodes):
+        for each_typecode in typecodes:
+            try:
+                data = array(each_typecode, values).tobytes()
+                break
+            except OverflowError:
+                continue
+        else:
+            raise InvalidPack("Values exceed %s" % typecodes)
+        return cls.ARRAY.pack(each_typecode.encode("ascii"), len(data)) \
+            + cls._padded(data)
+
+    @classmethod
+    def _padded(cls, data):
+        return data + bytes(-len(data) % cls.ALIGNMENT)
+
+    @staticmethod
+    def _digest_of(text):
+        return sha256(text.encode("utf-8")).digest()
+
+    @classmethod
+    def unpack(cls, buffer, text, symbols):
+        """
+        The tokens packed in the given buffer, whose text is taken from
+        the given source text. Spans of text are bound to the given
+        symbol table.
+        """
+        views = [memoryview(buffer)]
+        try:
+            return cls._unpack(views, text, symbols)
+        except InvalidPack:
+            raise
+        except (ValueError, TypeError) as error:
+            raise InvalidPack("Corrupted pack: %s" % error) from error
+        finally:
+            for each_view in reversed(views):
+                each_view.release()
+
+    @classmethod
+    def _unpack(cls, views, text, symbols):
+        """Unpack the first of the given views, and add to them the
+        views it creates, so that they can be released at once"""
+        view = views[0]
+        try:
+            magic, version, byte_order, count, name_length, digest = \
+                cls.HEADER.unpack_from(view)
+        except struct.error as error:
+            raise InvalidPack("Truncated header") from error
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise InvalidPack("Not a pack of tokens (version %d)"
+                              % cls.VERSION)
+        if byte_order != cls.BYTE_ORDERS[sys.byteorder]:
+            raise InvalidPack("Packed with another byte order")
+        if digest != cls._digest_of(text):
+            raise InvalidPack("Packed from another text")
+        offset = cls.HEADER.size
+        name = bytes(view[offset:offset + name_length]).decode("utf-8")
+        offset += name_length + (-name_length % cls.ALIGNMENT)
+        arrays = []
+        for _ in range(4):
+            offset = cls._unpack_array(view, offset, views)
+            if len(views[-1]) != count:
+                raise InvalidPack("Expected %d values" % count)
+            arrays.append(views[-1])
+        return cls._tokens(text, name, symbols, *arrays)
+
+    @classmethod
+    def _unpack_array(cls, view, offset, views):
+        try:
+            typecode, size = cls.ARRAY.unpack_from(view, offset)
+        except struct.error as error:
+            raise InvalidPack("Truncated array") from error
+        start = offset + cls.ARRAY.size
+        views.append(view[start:start + size])
+        if len(views[-1]) != size:
+            raise InvalidPack("Truncated array")
+        views.append(views[-1].cast(typecode.decode("ascii")))
+        return start + size + (-size % cls.ALIGNMENT)
+
+    @staticmethod
+    def _tokens(text, name, symbols, categories, lengths, lines, columns):
+        tokens = []
+        line, column, offset = 1, 0, 0
+        for category, length, line_offset, column_offset \
+                in zip(categories, lengths, lines, columns):
+            line += line_offset
+            column += column_offset
+            location = Position(line, column, name)
+            token_text = text[offset:offset + length]
+            if category == Symbol.TEXT.value:
+                tokens.append(TextSpan(token_text, location, symbols))
+            else:
+                tokens.append(Token(token_text, Symbol(category), location))
+            offset += length
+        return tokens
+
+    @classmethod
+    def save(cls, path, tokens, text, name):
+        """
+        Pack the given tokens into the given file. The pack is written
+        aside, and then moved onto that file, so that other runs that
+        have it memory-mapped never see it truncated.
+        """
+        packed = cls.pack(tokens, text, name)
+        file = NamedTemporaryFile(dir=os.path.dirname(path) or None,
+                                  suffix=".tmp",
+                                  delete=False)
+        try:
+            with file:
+                file.write(packed)
+            os.replace(file.name, path)
+        except Exception:
+            os.remove(file.name)
+            raise
+
+    @classmethod
+    def load(cls, path, text, symbols):
+        """The tokens packed in the given file, which is memory-mapped"""
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                raise InvalidPack("Empty pack")
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                    as mapping:
+                return cls.unpack(mapping, text, symbols)
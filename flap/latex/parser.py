@@ -18,21 +18,55 @@
 #
 
 from flap import logger
-from flap.latex.commons import Context, Stream, Source
+from flap.latex.commons import Context, Expansions, Stream, Source, \
+    Position, TextMatcher
 from flap.latex.lexer import Lexer
 from flap.latex.processor import Processor
+from flap.latex.symbols import Symbol
+from flap.latex.tokens import DeferredText, RawText
 
 
 class Factory:
 
-    def __init__(self, symbols):
+    def __init__(self, symbols, cache=None):
         self._symbols = symbols
+        self._cache = cache
+
+    @property
+    def symbols(self):
+        return self._symbols
 
     def as_tokens(self, text, name):
         return Lexer(self._symbols, Source.with_name(text, name))
 
     def as_list(self, text):
-        return list(Lexer(self._symbols, Source.anonymous(text)))
+        return Lexer.tokens_of(self._symbols, Source.anonymous(text))
+
+    def as_raw_text(self, text, name=None, location=None):
+        source = Source.with_name(text, name) if name \
+            else Source.anonymous(text)
+        return RawText(text,
+                       location or Position(1, 1, source.name),
+                       Lexer(self._symbols, source))
+
+    def as_deferred_text(self, compute, location):
+        return DeferredText(
+            compute,
+            location,
+            lambda text: Lexer(self._symbols, Source.anonymous(text)))
+
+    def as_included(self, content, parser, name=None):
+        """
+        The tokens of an included file, that is a single raw text, if
+        the given parser has nothing to rewrite in it. Otherwise, the
+        tokens come from the cache, if any.
+        """
+        if not content or parser.needs_rewriting(content):
+            if self._cache is not None and name is not None:
+                return self._cache.tokens_of(name, content, self._symbols)
+            return self.as_list(content)
+        logger.debug("Nothing to rewrite, copied as is")
+        return [self.as_raw_text(content)]
 
     def as_stream(self, tokens):
         return Stream(tokens)
@@ -40,21 +74,23 @@ class Factory:
 
 class Parser(Processor):
 
-    def __init__(self, tokens, factory, environment):
+    def __init__(self, tokens, factory, environment, expansions=None):
         super().__init__("REWRITER", tokens, factory, environment)
+        self._expansions = expansions or Expansions()
+        self._interpreter = None
+        self._reader = None
 
     def process_control(self, token):
         self._log("On command:" + str(token))
-        command = str(token)
-        command_name = command[1:]
-        if command_name not in self._definitions:
+        command_name = token.as_text[1:]
+        macro = self._definitions.look_up(command_name)
+        if macro is None:
             self._log("Unknown command '{}'.\n"
                       "\tCandidates are {}"
                       .format(command_name,
                               self._definitions.available_macros))
             self._print([token])
         else:
-            macro = self._definitions[command_name]
             invocation = macro.capture_invocation(self, token)
             self._log(invocation.as_text)
             self._tokens.push(invocation)
@@ -69,15 +105,27 @@ class Parser(Processor):
             for each_argument, tokens in invocation.arguments.items():
                 evaluated = self.evaluate(tokens)
                 self._definitions[each_argument] = evaluated
-            self.evaluate(macro._body)
+            if not macro.is_inert:
+                self.evaluate(macro._body)
             self.close_scope()
 
         else:   # Built-in commands
             self._log("Built-in!")
-            macro.execute2(self, invocation)
+            self._execute(macro, invocation)
 
         self._print(macro.rewrite2(self, invocation))
 
+    def _execute(self, macro, invocation):
+        if macro.requires_expansion:
+            self._expansions.record(macro)
+        macro.execute2(self, invocation)
+
+    @property
+    def rewrites(self):
+        """True if the output of this parser is rewritten LaTeX, as
+        opposed to the value of an expression"""
+        return True
+
     @property
     def _next_token(self):
         next_token = self._tokens.look_ahead()
@@ -86,6 +134,63 @@ class Parser(Processor):
     def define(self, macro):
         self._definitions.define(macro)
 
+    def needs_rewriting(self, text):
+        """
+        Cheap pre-scan of the given text, which tells whether it may
+        contain something to rewrite, that is a parameter or a command
+        that is currently defined. It returns True whenever in doubt.
+        """
+        if not isinstance(text, str):
+            return True
+        symbols = self._create.symbols
+        if any(marker in text for marker in symbols[Symbol.PARAMETER]):
+            return True
+        for each_marker in symbols[Symbol.CONTROL]:
+            start = text.find(each_marker)
+            while start != -1:
+                end = self._end_of_command(text, start + 1)
+                name = text[start + 1:end]
+                if name == "begin":
+                    if self._begins_a_known_environment(text, end):
+                        return True
+                elif name in self._definitions:
+                    return True
+                start = text.find(each_marker, end)
+        return False
+
+    def _end_of_command(self, text, start):
+        letters = self._create.symbols[Symbol.CHARACTER]
+        end = start
+        while end < len(text) and text[end] in letters:
+            end += 1
+        return end if end > start else start + 1
+
+    def _begins_a_known_environment(self, text, start):
+        symbols = self._create.symbols
+        if start >= len(text) or text[start] not in symbols.BEGIN_GROUP:
+            return True
+        end = min((position
+                   for position in (text.find(marker, start)
+                                    for marker in symbols.END_GROUP)
+                   if position != -1),
+                  default=-1)
+        if end == -1:
+            return True
+        return text[start + 1:end] in self._definitions
+
+    def offset_in(self, text):
+        """
+        The number of characters of the given text that this parser has
+        processed, or None if it does not read that text straight from
+        a lexer, or if some tokens are pending (e.g., the expansion of
+        a macro or the content of an included file).
+        """
+        lexer = self._tokens.source
+        if not isinstance(lexer, Lexer) or not lexer.reads(text) \
+                or self._tokens.has_pending or len(self._outputs) > 1:
+            return None
+        return lexer.offset
+
     def flush(self, source_name):
         while self._next_token \
               and self._next_token.location.source == source_name:
@@ -105,48 +210,63 @@ class Parser(Processor):
 
     @property
     def read(self):
-        reader = Reader("", self._create)
-        reader._tokens = self._tokens
-        return reader
+        """
+        The reader that captures arguments from this parser's tokens.
+        It is created once, and then reset before each capture.
+        """
+        if self._reader is None:
+            self._reader = Reader("", self._create)
+        self._reader.start_reading(self._tokens)
+        return self._reader
 
     def rewrite(self, tokens, extra_definitions=None):
         definitions = self._definitions
         if extra_definitions:
             definitions = Context(self._definitions, extra_definitions)
-        return Parser(tokens, self._create, definitions).process()
+        return Parser(tokens,
+                      self._create,
+                      definitions,
+                      self._expansions).process()
 
     def evaluate(self, tokens, extra_definitions=None):
         definitions = self._definitions
         if extra_definitions:
             definitions = Context(self._definitions, extra_definitions)
-        return Interpreter(tokens, self._create, definitions).process()
+        return self._evaluator.evaluate_within(definitions, tokens)
 
     def evaluate_as_text(self, tokens):
-        interpreter = Interpreter(tokens, self._create, self._definitions)
-        return self._as_text(interpreter.process())
+        return self._as_text(self.evaluate(tokens))
+
+    @property
+    def _evaluator(self):
+        """The interpreter that evaluates expressions on behalf of this
+        parser, created once and reused for every evaluation"""
+        if self._interpreter is None:
+            self._interpreter = Interpreter([],
+                                            self._create,
+                                            self._definitions,
+                                            self._expansions)
+        return self._interpreter
 
     def shall_expand(self):
+        """
+        True if a macro that requires expansion was executed since the
+        last call.
+        """
         logger.debug("Expanding")
-        result = False
-        for _, any_macro in self._definitions.items():
-            was_called = getattr(any_macro, "was_called", None)
-            if was_called \
-               and any_macro.was_called \
-               and any_macro.requires_expansion:
-                result = True
-        for _, any_macro in self._definitions.items():
-            was_called = getattr(any_macro, "was_called", None)
-            if was_called:
-                any_macro._called = False
-        return result
+        return self._expansions.check()
 
 
 class Interpreter(Parser):
 
-    def __init__(self, tokens, factory, environment):
-        super().__init__(tokens, factory, environment)
+    def __init__(self, tokens, factory, environment, expansions=None):
+        super().__init__(tokens, factory, environment, expansions)
         self._name = "INTERPRETER"
 
+    @property
+    def rewrites(self):
+        return False
+
     def process_begin_group(self, token):
         pass
 
@@ -160,33 +280,72 @@ class Interpreter(Parser):
         else:
             raise RuntimeError(f"Undefined symbol '{str(parameter)}'")
 
+    def needs_rewriting(self, text):
+        # The interpreter drops groups, so they must be read as well
+        symbols = self._create.symbols
+        if any(marker in text
+               for marker in symbols.BEGIN_GROUP + symbols.END_GROUP):
+            return True
+        return super().needs_rewriting(text)
+
     def process_invocation(self, invocation):
         self._log("On invocation: " + invocation.as_text)
         macro = self.look_up(invocation.command_name)
 
         if macro.is_user_defined:
             self._log("User defined!")
-            self.open_scope()
-            for each_argument, tokens in invocation.arguments.items():
-                evaluated = self.evaluate(tokens)
-                self._definitions[each_argument] = evaluated
-            output = self.evaluate(macro._body)
+            key = macro.expansion_key(invocation)
+            output = macro.memoised_expansion(key)
+            if output is None:
+                output = self._expand(macro, invocation)
+                macro.memoise(key, output)
             self._print(output)
-            self.close_scope()
 
         else:   # Built-in commands
             self._log("Built-in!")
-            macro.execute2(self, invocation)
-
-    def evaluate(self, tokens, extra_definitions=None):
-        definitions = self._definitions
-        if extra_definitions:
-            definitions = Context(self._definitions, extra_definitions)
-        return Interpreter(tokens, self._create, definitions).process()
+            self._execute(macro, invocation)
+
+    def _expand(self, macro, invocation):
+        self.open_scope()
+        for each_argument, tokens in invocation.arguments.items():
+            evaluated = self.evaluate(tokens)
+            self._definitions[each_argument] = evaluated
+        if macro.is_inert:
+            output = macro.expand_with(self)
+        else:
+            output = self.evaluate(macro._body)
+        self.close_scope()
+        return output
 
-    def evaluate_as_text(self, tokens):
-        interpreter = Interpreter(tokens, self._create, self._definitions)
-        return self._as_text(interpreter.process())
+    @property
+    def _evaluator(self):
+        return self
+
+    def evaluate_within(self, definitions, tokens):
+        """
+        Evaluate the given tokens in the given context. Plain text (with
+        neither command nor parameter) evaluates to itself, without its
+        groups. Otherwise, the tokens are evaluated in place, on a
+        stream and an output of their own, so that evaluations can be
+        nested.
+        """
+        if not any(each.is_a_command or each.is_a_parameter
+                   for each in tokens):
+            return [each for each in tokens
+                    if not (each.begins_a_group or each.ends_a_group)]
+        saved_tokens, saved_definitions = self._tokens, self._definitions
+        self._tokens = self._create.as_stream(tokens)
+        self._definitions = definitions
+        self.push_new_output()
+        try:
+            while not self._tokens.is_empty:
+                token = self._tokens.take()
+                token.send_to(self)
+        finally:
+            output = self._outputs.pop()["data"]
+            self._tokens = saved_tokens
+            self._definitions = saved_definitions
+        return output
 
 
 
@@ -196,10 +355,48 @@ class Reader(Parser):
         super().__init__(tokens, factory, dict())
         self._name = "READER"
 
+    def start_reading(self, tokens):
+        """
+        Read from the given stream, into a new output
+        """
+        self._tokens = tokens
+        self._outputs = [{"is_active": True, "data": []}]
+
+    def _take(self):
+        """
+        Take the next token, breaking text spans into their tokens, so
+        that macro arguments are captured token by token.
+        """
+        token = self._tokens.take()
+        while token is not None and token.is_a_text_span:
+            tokens = token.tokens()
+            self._tokens.push(tokens[1:])
+            token = tokens[0]
+        return token
+
+    def _take_span(self):
+        """
+        Take the next token, keeping text spans whole, but breaking raw
+        texts, which may contain anything.
+        """
+        token = self._tokens.take()
+        while token is not None and token.is_raw_text:
+            tokens = token.tokens()
+            self._tokens.push(tokens[1:])
+            token = tokens[0]
+        return token
+
+    @property
+    def _next_token(self):
+        token = self._take()
+        if token is not None:
+            self._tokens.push(token)
+        return token
+
     def one(self):
         self._log("Reading one ...")
         if not self._tokens.is_empty:
-            token = self._tokens.take()
+            token = self._take()
             token.send_to(self)
             return self._outputs[-1]["data"]
         return None
@@ -213,7 +410,7 @@ class Reader(Parser):
     def only_if(self, is_expected):
         self._log("Reading only if  ...")
         if not self._tokens.is_empty:
-            token = self._tokens.take()
+            token = self._take()
             if is_expected(token):
                 token.send_to(self)
             else:
@@ -223,7 +420,7 @@ class Reader(Parser):
     def until(self, is_end):
         self._log("Reading until ...")
         while not self._tokens.is_empty:
-            token = self._tokens.take()
+            token = self._take()
             if is_end(token):
                 self._tokens.push(token)
                 break
@@ -257,37 +454,87 @@ class Reader(Parser):
     def ignored(self):
         while self._next_token \
               and self._next_token.is_ignored:
-            token = self._tokens.take()
+            token = self._take()
             token.send_to(self)
         return self._outputs[-1]["data"]
 
     def text(self, marker):
         self._log("Reading text '%s'" % marker)
-        text = ""
-        while self._next_token:
-            token = self._tokens.take()
-            text += str(token)
-            if not marker.startswith(text):
+        offset = 0
+        token = self._take()
+        while token is not None:
+            text = str(token)
+            if not marker.startswith(text, offset):
                 self._tokens.push(token)
                 break
+            offset += len(text)
             token.send_to(self)
+            token = self._take()
         return self._outputs[-1]["data"]
 
     def until_text(self, marker, capture_marker=False):
         self._log("Reading until text '%s' ..." % marker)
-        text = ""
-        while self._next_token:
-            token = self._tokens.take()
-            text += str(token)
-            if text.endswith(marker):
+        matcher = TextMatcher(marker)
+        token = self._take_span()
+        while token is not None:
+            if token.is_a_text_span:
+                if matcher.skip(str(token)):
+                    self._print([token])
+                    token = self._take_span()
+                    continue
+                tokens = token.tokens()
+                self._tokens.push(tokens[1:])
+                token = tokens[0]
+            if matcher.feed(str(token)):
                 if capture_marker:
                     self._print([token])
                 else:
                     self._tokens.push(token)
                 break
             self._print([token])
+            token = self._take_span()
         return self._outputs[-1]["data"]
 
+    def raw_until(self, marker):
+        """
+        Read up to, and including, the given marker. The text before
+        the marker comes as a single opaque token. Whenever the stream
+        reads straight from a lexer, the source text is searched for
+        the marker, without lexing it.
+        """
+        self._log("Reading raw text until '%s' ..." % marker)
+        matcher = TextMatcher(marker)
+        lexer = self._tokens.source
+        if not isinstance(lexer, Lexer):
+            lexer = None
+        text = []
+        location = None
+        while True:
+            if lexer and matcher.is_idle and not self._tokens.has_pending:
+                if location is None:
+                    location = lexer.position.next_character()
+                text.append(lexer.take_until(marker))
+                self.push_new_output()
+                self.until_text(marker, True)
+                marker_tokens = self.pop_output()
+                break
+            token = self._take()
+            if token is None:
+                marker_tokens = []
+                break
+            if location is None:
+                location = token.location
+            text.append(str(token))
+            if matcher.feed(str(token)):
+                text = ["".join(text)[:-len(marker)]]
+                marker_tokens = self._create.as_list(marker)
+                break
+        text = "".join(text)
+        if not text:
+            return marker_tokens
+        return [self._create.as_raw_text(text, location=location)] \
+            + marker_tokens
+
     def _raise_unexpected_token(self, expected, actual):
         error = (
             "Expected {}, but found '{}' in file {} (l. {}, col. {})"
@@ -307,17 +554,29 @@ class Reader(Parser):
         self._default(token)
 
     def process_begin_group(self, token):
+        """
+        Read the whole group, including nested ones, into the current
+        output. Nested groups are tracked on an explicit stack, which
+        holds the index where each open group starts in the output.
+        """
         self._log("On begin group")
-        self.push_new_output()
-        self._print([token])
-        self.until(lambda t: t.ends_a_group)
-        self.only_if(lambda t: t.ends_a_group)
+        output = self._outputs[-1]["data"]
+        openings = []
+        while token is not None:
+            if token.begins_a_group:
+                openings.append(len(output))
+            elif token.ends_a_group:
+                openings.pop()
+            output.append(token)
+            if not openings:
+                return
+            token = self._take_span()
+        self._log("Unterminated group, opened at %s"
+                  % output[openings[-1]].location)
 
     def process_end_group(self, end_group):
         self._log("On end group")
         self._print([end_group])
-        group_tokens = self.pop_output()
-        self._print(group_tokens)
 
     def process_invocation(self, invocation):
         raise RuntimeError("Reader should never meet an invocation token!")
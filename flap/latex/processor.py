@@ -68,11 +68,14 @@ class Processor:
     def process_others(self, other):
         self._default(other)
 
+    def process_text(self, text):
+        self._default(text)
+
     def process_invocation(self, invocation):
         self._default(invocation)
 
     def _default(self, token):
-        self._log("On " + str(token))
+        self._log("On " + repr(token))
         self._print([token])
 
     # Helpers
@@ -108,7 +111,7 @@ class Processor:
         self._definitions = Context(self._definitions)
 
     def close_scope(self):
-        self._definitions = self._definitions._parent
+        self._definitions = self._definitions.close()
 
     def look_up(self, symbol):
         return self._definitions.look_up(symbol)
@@ -19,6 +19,7 @@
 
 from flap import logger
 from enum import Enum, unique
+from itertools import count
 
 
 @unique
@@ -27,6 +28,10 @@ class Symbol(Enum):
     Define the categories of character as specified  by TeX.
 
     See https://en.wikibooks.org/wiki/TeX/catcode
+
+    TEXT is not a TeX category: it marks spans of letters, blanks and
+    other characters that the lexer groups together, because FLaP
+    passes them through unchanged.
     """
     CONTROL = 0
     BEGIN_GROUP = 1
@@ -45,12 +50,17 @@ class Symbol(Enum):
     COMMENT = 14
     INVALID = 15
     END_OF_TEXT = 16
+    TEXT = 17
 
 
 class SymbolTable:
     """
     Characters recognised by (La)TeX, augmented with some relevant for
     parsing such new lines.
+
+    Tables are copied on write: a clone shares the categories of its
+    original until either of them changes, so cloning takes constant
+    time. The lists of characters tables expose must not be modified.
     """
 
     @staticmethod
@@ -76,14 +86,57 @@ class SymbolTable:
         })
 
 
+    PLAIN_CATEGORIES = (Symbol.CHARACTER, Symbol.WHITE_SPACES, Symbol.OTHERS)
+
+    _versions = count()
+
     def __init__(self, symbols):
         self._symbols = symbols
+        self._is_shared = False
+        self._version = next(self._versions)
+        self._fingerprint = None
+
+    @property
+    def version(self):
+        """
+        A number that changes whenever this table changes. Only its
+        clones share it, until they change.
+        """
+        return self._version
+
+    @property
+    def fingerprint(self):
+        """
+        A text that describes the categories of this table, and which
+        tables with the same categories thus share. It can key what is
+        derived from these categories, such as lexed tokens.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = "\n".join(
+                "{}:{}".format(each_category.value,
+                               "".join(sorted(each_characters)))
+                for each_category, each_characters
+                in sorted(self._symbols.items(),
+                          key=lambda entry: entry[0].value))
+        return self._fingerprint
 
     def clone(self):
-        categories = {each_category: each_characters.copy()
-                      for each_category, each_characters
-                      in self._symbols.items()}
-        return SymbolTable(categories)
+        clone = SymbolTable(self._symbols)
+        clone._version = self._version
+        clone._fingerprint = self._fingerprint
+        clone._is_shared = self._is_shared = True
+        return clone
+
+    def _will_change(self):
+        """Copy the categories, if they are shared with other tables,
+        and give this table a new version"""
+        if self._is_shared:
+            self._symbols = {each_category: each_characters.copy()
+                             for each_category, each_characters
+                             in self._symbols.items()}
+            self._is_shared = False
+        self._version = next(self._versions)
+        self._fingerprint = None
 
     def assign(self, character, category_code):
         assert isinstance(character, str), \
@@ -94,6 +147,7 @@ class SymbolTable:
         assert isinstance(category_code, int), \
             "Expect category as an integer, but got {}".format(
                 type(category_code))
+        self._will_change()
         self._remove(character)
         category = Symbol(category_code)
         if category != Symbol.OTHERS:
@@ -113,18 +167,33 @@ class SymbolTable:
         # there is no need to remove it. OTHER is only the default
 
     def __getitem__(self, key):
-        assert key in list(
-            Symbol), "Symbol table only maps symbol categories to symbol lists"
+        assert isinstance(key, Symbol), \
+            "Symbol table only maps symbol categories to symbol lists"
         return self._symbols.get(key, [])
 
     def __setitem__(self, key, value):
-        assert key in list(
-            Symbol), "Symbol table only maps symbol categories to symbol lists"
+        assert isinstance(key, Symbol), \
+            "Symbol table only maps symbol categories to symbol lists"
+        self._will_change()
         self._symbols[key] = value
 
     def match(self, character, category):
         return character in self._symbols[category]
 
+    def categories(self):
+        """The pairs of categories and characters, in lookup order"""
+        return list(self._symbols.items())
+
+    def special_characters(self):
+        """
+        The characters that are neither letters, blanks nor others, and
+        which therefore end text spans.
+        """
+        return {each_character
+                for each_category, each_characters in self._symbols.items()
+                if each_category not in self.PLAIN_CATEGORIES
+                for each_character in each_characters}
+
     def category_of(self, character):
         for category, markers in self._symbols.items():
             if character in markers:
@@ -149,6 +218,6 @@ class SymbolTable:
         instead of:
         >>> table[Symbol.CHARACTER]
         """
-        if item in [each.name for each in list(Symbol)]:
+        if item in Symbol.__members__:
             return self._symbols[Symbol[item]]
         return self.__getattribute__(item)
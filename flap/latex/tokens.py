@@ -18,6 +18,7 @@
 #
 
 
+from flap.latex.commons import Position
 from flap.latex.symbols import Symbol, SymbolTable
 
 
@@ -26,6 +27,19 @@ class Token:
 
     DISPLAY = "{category}({text}){location}"
 
+    HANDLERS = {
+        Symbol.BEGIN_GROUP: "process_begin_group",
+        Symbol.COMMENT: "process_comment",
+        Symbol.CONTROL: "process_control",
+        Symbol.CHARACTER: "process_character",
+        Symbol.WHITE_SPACES: "process_white_spaces",
+        Symbol.PARAMETER: "process_parameter",
+        Symbol.END_GROUP: "process_end_group",
+        Symbol.OTHERS: "process_others",
+        Symbol.NEW_LINE: "process_new_line",
+        Symbol.TEXT: "process_text"
+    }
+
     def __init__(self, text, category, location):
         self._text = text
         self._category = category
@@ -36,18 +50,7 @@ class Token:
         Dispatch the appropriate 'rewrite' method depending on the type of
         tokens.
         """
-        handler_names = {
-            Symbol.BEGIN_GROUP: "process_begin_group",
-            Symbol.COMMENT: "process_comment",
-            Symbol.CONTROL: "process_control",
-            Symbol.CHARACTER: "process_character",
-            Symbol.WHITE_SPACES: "process_white_spaces",
-            Symbol.PARAMETER: "process_parameter",
-            Symbol.END_GROUP: "process_end_group",
-            Symbol.OTHERS: "process_others",
-            Symbol.NEW_LINE: "process_new_line"
-        }
-        handler_name = handler_names.get(self._category,
+        handler_name = self.HANDLERS.get(self._category,
                                          self._category.name)
         handler = getattr(parser, handler_name)
         return handler(self)
@@ -113,6 +116,14 @@ class Token:
     def is_a_whitespace(self):
         return self._category == Symbol.WHITE_SPACES
 
+    @property
+    def is_a_text_span(self):
+        return self._category == Symbol.TEXT
+
+    @property
+    def is_raw_text(self):
+        return False
+
     def __eq__(self, other_token):
         if not isinstance(other_token, Token):
             return False
@@ -129,6 +140,126 @@ class Token:
         return self._text
 
 
+class TextSpan(Token):
+    """
+    A run of letters, blanks and other characters (e.g., digits or
+    punctuation), which the parser passes through as a single token.
+    Readers that need the individual tokens (e.g., when capturing macro
+    arguments) split it on demand.
+    """
+
+    def __init__(self, text, location, symbols):
+        super().__init__(text, Symbol.TEXT, location)
+        self._symbols = symbols
+
+    def split(self):
+        """
+        Detach the first token (a single character or a run of blanks)
+        and return it, together with the span of the remaining text, if
+        any.
+        """
+        head, length = self._token_at(0, self._letters, self._blanks)
+        if length == len(self._text):
+            return head, None
+        location = Position(self._location.line,
+                            self._location.column + length,
+                            self._location.source)
+        return head, TextSpan(self._text[length:], location, self._symbols)
+
+    def tokens(self):
+        """
+        Split the whole span at once, in a single pass over its text.
+        """
+        letters, blanks = self._letters, self._blanks
+        tokens = []
+        start = 0
+        while start < len(self._text):
+            token, start = self._token_at(start, letters, blanks)
+            tokens.append(token)
+        return tokens
+
+    @property
+    def _letters(self):
+        return self._symbols[Symbol.CHARACTER]
+
+    @property
+    def _blanks(self):
+        return self._symbols[Symbol.WHITE_SPACES]
+
+    def _token_at(self, start, letters, blanks):
+        """
+        Return the token that starts at the given index, and the index
+        where it ends.
+        """
+        text = self._text
+        location = Position(self._location.line,
+                            self._location.column + start,
+                            self._location.source)
+        if text[start] in blanks:
+            end = start + 1
+            while end < len(text) and text[end] in blanks:
+                end += 1
+            return Token(text[start:end], Symbol.WHITE_SPACES, location), end
+        if text[start] in letters:
+            return Token(text[start], Symbol.CHARACTER, location), start + 1
+        return Token(text[start], Symbol.OTHERS, location), start + 1
+
+
+class RawText(Token):
+    """
+    A whole fragment of source text, copied verbatim into the output.
+    The given tokens, which must be computed lazily, are only needed
+    if a reader has to look inside.
+    """
+
+    def __init__(self, text, location, tokens):
+        super().__init__(text, Symbol.TEXT, location)
+        self._tokens = tokens
+
+    @property
+    def is_raw_text(self):
+        return True
+
+    def split(self):
+        tokens = self.tokens()
+        return tokens[0], tokens[1:]
+
+    def tokens(self):
+        return list(self._tokens)
+
+
+class DeferredText(RawText):
+    """
+    Raw text that is computed elsewhere (e.g., on another thread), and
+    only awaited when its text is first needed. Its tokens are lexed
+    from that text, using the given function.
+    """
+
+    def __init__(self, compute, location, lex):
+        super().__init__(None, location, None)
+        self._compute = compute
+        self._lex = lex
+
+    @property
+    def as_text(self):
+        if self._text is None:
+            self._text = self._compute()
+        return self._text
+
+    def tokens(self):
+        return list(self._lex(self.as_text))
+
+    def __repr__(self):
+        if self._text is None:
+            return self.DISPLAY.format(location=self._location,
+                                       text="...",
+                                       category="deferred")
+        return super().__repr__()
+
+    def __str__(self):
+        return self.as_text
+
+
 class TokenFactory:
 
     def __init__(self, symbol_table):
@@ -148,6 +279,9 @@ class TokenFactory:
     def white_space(location, text):
         return Token(text, Symbol.WHITE_SPACES, location)
 
+    def text(self, location, text):
+        return TextSpan(text, location, self._symbols)
+
     @staticmethod
     def comment(location, text):
         return Token(text, Symbol.COMMENT, location)
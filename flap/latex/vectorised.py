@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from flap.latex.commons import Position
+from flap.latex.symbols import Symbol, SymbolTable
+from flap.latex.tokens import TokenFactory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class VectorisedLexer:
+    """
+    A lexer for very large sources, which yields the same tokens as the
+    Lexer, but maps the whole source at once to an array of categories,
+    using NumPy. Only special characters (e.g., '\\', '{' or '%') are
+    then visited one by one: the text spans in between, the ends of
+    command names and comments, and the positions of all tokens are
+    found on whole arrays.
+
+    Unlike the Lexer, it lexes the source under the symbol table as it
+    is when lexing starts. It requires NumPy, and supports only the
+    categories the Lexer handles.
+    """
+
+    THRESHOLD = 1 << 18
+
+    PLAIN = 0xFF
+
+    SUPPORTED = frozenset([
+        Symbol.CONTROL, Symbol.BEGIN_GROUP, Symbol.END_GROUP, Symbol.MATH,
+        Symbol.NEW_LINE, Symbol.PARAMETER, Symbol.SUPERSCRIPT,
+        Symbol.SUBSCRIPT, Symbol.WHITE_SPACES, Symbol.CHARACTER,
+        Symbol.OTHERS, Symbol.NON_BREAKING_SPACE, Symbol.COMMENT
+    ])
+
+    @staticmethod
+    def is_available():
+        return numpy is not None
+
+    @classmethod
+    def applies_to(cls, symbols, source):
+        """True if the given source is large enough to be worth lexing
+        with NumPy, and if NumPy supports the given symbol table"""
+        return cls.is_available() \
+            and len(source.content) >= cls.THRESHOLD \
+            and cls.supports(symbols)
+
+    @classmethod
+    def supports(cls, symbols):
+        return all(each_category in cls.SUPPORTED
+                   for each_category, each_characters in symbols.categories()
+                   if each_characters)
+
+    def __init__(self, symbols, source):
+        assert self.is_available(), "The vectorised lexer requires NumPy"
+        self._symbols = symbols
+        self._source = source
+        self._tokens = TokenFactory(symbols)
+        self._text = source.content
+        self._codes = numpy.frombuffer(self._text.encode("utf-32-le"),
+                                       dtype="<u4")
+        self._handlers = {
+            Symbol.WHITE_SPACES.value: self._tokens.white_space,
+            Symbol.CHARACTER.value: self._tokens.character,
+            Symbol.OTHERS.value: self._tokens.others,
+            Symbol.TEXT.value: self._tokens.text,
+            Symbol.CONTROL.value: self._tokens.command,
+            Symbol.COMMENT.value: self._tokens.comment,
+            Symbol.PARAMETER.value: self._tokens.parameter,
+            Symbol.MATH.value:
+                lambda location, text: self._tokens.math(location),
+            Symbol.NEW_LINE.value: self._tokens.new_line,
+            Symbol.BEGIN_GROUP.value: self._tokens.begin_group,
+            Symbol.END_GROUP.value: self._tokens.end_group,
+            Symbol.SUPERSCRIPT.value: self._tokens.superscript,
+            Symbol.SUBSCRIPT.value: self._tokens.subscript,
+            Symbol.NON_BREAKING_SPACE.value:
+                self._tokens.non_breaking_space
+        }
+
+    def tokens(self):
+        """All the tokens of the source"""
+        new_lines = numpy.flatnonzero(self._lookup([Symbol.NEW_LINE]))
+        starts, ends, categories = self._boundaries(new_lines)
+        lines, columns = self._positions_of(starts, new_lines)
+        text, name, handlers = self._text, self._source.name, self._handlers
+        return [handlers[category](Position(line, column, name),
+                                   text[start:end])
+                for start, end, category, line, column
+                in zip(starts.tolist(), ends.tolist(), categories.tolist(),
+                       lines.tolist(), columns.tolist())]
+
+    def _lookup(self, categories):
+        """The characters of the source that belong to the given
+        categories, as an array of booleans"""
+        characters = [ord(each_character)
+                      for each_category, each_characters
+                      in self._symbols.categories()
+                      if each_category in categories
+                      for each_character in each_characters]
+        table = numpy.zeros(max(characters, default=0) + 2, dtype=bool)
+        table[characters] = True
+        return table[numpy.minimum(self._codes, len(table) - 1)]
+
+    def _category_table(self):
+        """The category of each special character, as an array indexed
+        by character codes, where PLAIN stands for the others"""
+        specials = dict()
+        for each_category, each_characters \
+                in reversed(self._symbols.categories()):
+            for each_character in each_characters:
+                specials[ord(each_character)] = each_category
+        table = numpy.full(max(specials, default=0) + 2,
+                           self.PLAIN,
+                           dtype=numpy.uint8)
+        for code, category in specials.items():
+            if category not in SymbolTable.PLAIN_CATEGORIES:
+                table[code] = category.value
+        return table
+
+    def _boundaries(self, new_lines):
+        """
+        The start, the end and the category of every token, as arrays.
+        """
+        length = len(self._text)
+        table = self._category_table()
+        kinds = table[numpy.minimum(self._codes, len(table) - 1)]
+        specials = numpy.flatnonzero(kinds != self.PLAIN)
+        categories = kinds[specials]
+        ends = self._ends_of(specials, categories, new_lines)
+
+        all_starts, all_ends, all_categories = [], [], []
+        index = 0
+        for start, end, kind in zip(specials.tolist(),
+                                    ends.tolist(),
+                                    categories.tolist()):
+            if start < index:
+                continue
+            if start > index:
+                all_starts.append(index)
+                all_ends.append(start)
+                all_categories.append(self.PLAIN)
+            if kind == Symbol.PARAMETER.value:
+                end = self._end_of_parameter(end)
+            all_starts.append(start)
+            all_ends.append(end)
+            all_categories.append(kind)
+            index = end
+        if index < length:
+            all_starts.append(index)
+            all_ends.append(length)
+            all_categories.append(self.PLAIN)
+        starts = numpy.array(all_starts, dtype=numpy.int64)
+        ends = numpy.array(all_ends, dtype=numpy.int64)
+        categories = numpy.array(all_categories, dtype=numpy.uint8)
+        plain = categories == self.PLAIN
+        categories[plain] = self._categories_of(starts[plain], ends[plain])
+        return starts, ends, categories
+
+    def _categories_of(self, starts, ends):
+        """
+        The category of the runs of plain characters between the given
+        starts and ends: blanks, a single letter or other character, or
+        a text span.
+        """
+        if len(starts) == 0:
+            return numpy.empty(0, dtype=numpy.uint8)
+        blanks = numpy.append(self._lookup([Symbol.WHITE_SPACES]), True)
+        bounds = numpy.empty(2 * len(starts), dtype=numpy.int64)
+        bounds[0::2] = starts
+        bounds[1::2] = ends
+        only_blanks = numpy.logical_and.reduceat(blanks, bounds)[0::2]
+        letters = self._lookup([Symbol.CHARACTER])
+        single = numpy.where(letters[starts],
+                             Symbol.CHARACTER.value,
+                             Symbol.OTHERS.value)
+        return numpy.where(
+            only_blanks,
+            Symbol.WHITE_SPACES.value,
+            numpy.where(ends - starts == 1, single, Symbol.TEXT.value))
+
+    def _ends_of(self, specials, categories, new_lines):
+        """
+        Where the tokens that start with the given special characters
+        end, should they not be part of another token: command names
+        span the letters that follow, and comments span the rest of
+        their line.
+        """
+        length = len(self._text)
+        ends = specials + 1
+        letters = numpy.append(self._lookup([Symbol.CHARACTER]), False)
+        ends_of_names = numpy.flatnonzero(letters[:-1] & ~letters[1:]) + 1
+        commands = categories == Symbol.CONTROL.value
+        named = commands & letters[ends]
+        ends[commands & ~named & (ends < length)] += 1
+        ends[named] = ends_of_names[
+            numpy.searchsorted(ends_of_names, ends[named], side="right")]
+        comments = categories == Symbol.COMMENT.value
+        closing = numpy.append(new_lines, length)
+        ends[comments] = closing[
+            numpy.searchsorted(closing, ends[comments], side="left")]
+        return ends
+
+    def _end_of_parameter(self, end):
+        text, length = self._text, len(self._text)
+        while end < length and text[end].isdigit():
+            end += 1
+        return end
+
+    @staticmethod
+    def _positions_of(starts, new_lines):
+        """The line and column of the tokens starting at the given
+        indexes, as the Lexer computes them, given the indexes of the
+        new lines"""
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        before = numpy.searchsorted(new_lines, starts, side="left")
+        last_line_break = numpy.concatenate(([-1], new_lines))[before]
+        is_a_new_line = numpy.concatenate((new_lines, [-1]))[before] \
+            == starts
+        lines = numpy.where(is_a_new_line, before + 2, before + 1)
+        columns = numpy.where(is_a_new_line, 0, starts - last_line_break)
+        return lines, columns
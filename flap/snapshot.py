@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+
+from hashlib import sha256
+from threading import Lock
+
+from flap import logger
+from flap.latex.commons import Position
+from flap.latex.symbols import Symbol
+from flap.latex.tokens import DeferredText, TextSpan, Token
+from flap.util.path import Path
+
+
+def digest_of(text):
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+class SnapshotUnavailable(Exception):
+    """
+    Exception thrown when the state reached at the end of a preamble
+    cannot be saved (e.g., a macro body holds text computed elsewhere)
+    """
+
+
+class PreambleSnapshot:
+    """
+    The state reached at \\begin{document}, that is the macros defined
+    in the preamble, the character table, the graphics path, the
+    selected inclusions and the dependencies already relocated, along
+    with what the preamble produced: its rewriting, the modifications
+    made and the files written in the output directory.
+
+    Snapshots are saved as JSON, and hold the digests of the preamble
+    and of every file it read, so that they are only restored as long
+    as none of these files change.
+    """
+
+    FORMAT = 1
+
+    RAW_TEXT = -1
+
+    @classmethod
+    def load(cls, text):
+        """The snapshot saved in the given text, or None if it cannot be
+        read"""
+        try:
+            data = json.loads(text)
+            if data.get("format") != cls.FORMAT:
+                return None
+            snapshot = PreambleSnapshot(data["preamble"], data["end"])
+            snapshot._inputs = data["inputs"]
+            snapshot._outputs = data["outputs"]
+            snapshot._copies = data["copies"]
+            snapshot.state = data["state"]
+            snapshot.rewriting = data["rewriting"]
+            snapshot.journal = data["journal"]
+            return snapshot
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.info("Ignoring unreadable preamble snapshot")
+            return None
+
+    def __init__(self, digest=None, end=None):
+        self._digest = digest
+        self._end = end
+        self._inputs = dict()
+        self._outputs = dict()
+        self._copies = dict()
+        self._lock = Lock()
+        self.state = None
+        self.rewriting = None
+        self.journal = None
+
+    @property
+    def end(self):
+        """The number of characters of the root document that make its
+        preamble, up to and including \\begin{document}"""
+        return self._end
+
+    def ends_at(self, text, end):
+        """Record that the preamble is made of the given number of
+        characters of the given root document"""
+        self._digest = digest_of(text[:end])
+        self._end = end
+
+    @property
+    def outputs(self):
+        """The files the preamble wrote, indexed by name"""
+        return self._outputs
+
+    @property
+    def copies(self):
+        """The files the preamble copied, indexed by name"""
+        return self._copies
+
+    def read(self, path, content):
+        with self._lock:
+            self._inputs[str(path)] = digest_of(content)
+
+    def wrote(self, name, content):
+        with self._lock:
+            self._outputs[name] = content
+
+    def copied(self, path, name):
+        with self._lock:
+            self._copies[name] = str(path)
+
+    def holds(self, text, file_system):
+        """
+        True if the given root document starts with the preamble this
+        snapshot was taken at, if none of the files it read has changed
+        since, and if those it copied still exist.
+        """
+        if self._end is None or self._end > len(text) \
+                or self._digest != digest_of(text[:self._end]):
+            return False
+        for each_path in self._copies.values():
+            if not self._exists(file_system, each_path):
+                return False
+        for each_path, each_digest in self._inputs.items():
+            if not self._exists(file_system, each_path) \
+                    or self._digest_of(file_system, each_path) != each_digest:
+                logger.info("'%s' has changed since the preamble snapshot",
+                            each_path)
+                return False
+        return True
+
+    @staticmethod
+    def _exists(file_system, path):
+        path = Path.fromText(path)
+        directory = file_system.open(path.container())
+        return any(each.fullname() == path.fullname()
+                   for each in directory.files())
+
+    @staticmethod
+    def _digest_of(file_system, path):
+        try:
+            return digest_of(file_system.open(Path.fromText(path)).content())
+        except OSError:
+            return None
+
+    def save(self):
+        return json.dumps({
+            "format": self.FORMAT,
+            "preamble": self._digest,
+            "end": self._end,
+            "inputs": self._inputs,
+            "outputs": self._outputs,
+            "copies": self._copies,
+            "state": self.state,
+            "rewriting": self.rewriting,
+            "journal": self.journal
+        })
+
+    @classmethod
+    def encode(cls, tokens):
+        """The given tokens, as lists that JSON can hold"""
+        encoded = []
+        for each_token in tokens:
+            if not isinstance(each_token, Token) \
+                    or isinstance(each_token, DeferredText):
+                raise SnapshotUnavailable(
+                    "Cannot save '%s'" % repr(each_token))
+            category = cls.RAW_TEXT if each_token.is_raw_text \
+                else each_token._category.value
+            location = each_token.location
+            encoded.append([each_token.as_text,
+                            category,
+                            location.line,
+                            location.column,
+                            location.source])
+        return encoded
+
+    @classmethod
+    def decode(cls, entries, factory):
+        """The tokens encoded in the given lists, recreated with the
+        given factory"""
+        tokens = []
+        for text, category, line, column, source in entries:
+            location = Position(line, column, source)
+            if category == cls.RAW_TEXT:
+                tokens.append(factory.as_raw_text(text, location=location))
+            elif category == Symbol.TEXT.value:
+                tokens.append(TextSpan(text, location, factory.symbols))
+            else:
+                tokens.append(Token(text, Symbol(category), location))
+        return tokens
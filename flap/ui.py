@@ -35,17 +35,23 @@ class Controller:
         self._file_system = file_system
         self._display = display
 
-    def run(self, tex_file, output):
+    def run(self, tex_file, output, snapshot=None, speculative=False,
+            token_cache=None):
         request = Settings(
             file_system=self._file_system,
             ui=self._display,
             root_tex_file=tex_file,
-            output=output)
+            output=output,
+            speculative=speculative,
+            snapshot=snapshot,
+            token_cache=token_cache)
         try:
             self._display.version()
             self._display.header()
-            request.execute()
-            self._display.footer(request._count, output)
+            run = request.execute()
+            self._display.footer(run.count,
+                                 output,
+                                 self._file_system.cache_statistics())
         except Exception as error:
             trace = traceback.extract_tb(sys.exc_info()[2])
             logger.error(error, exc_info=True)
@@ -67,6 +73,8 @@ class Display:
                           column="Column",
                           code="LaTeX Command")
     SUMMARY = "{count} modification(s)\n"
+    CACHE = ("File cache: {hits} hit(s), {misses} miss(es), "
+             "{evictions} eviction(s)\n")
     CLOSING = "Check out your flattened project in '{directory}'.\n"
     ERROR = ("Sorry, FLaP could not parse your file.\n\n"
              " - Error in method '{method}'({file_name}, l. {line}):\n"
@@ -96,10 +104,12 @@ class Display:
                        column=column,
                        code=escaped_code)
 
-    def footer(self, count, output):
+    def footer(self, count, output, cache=None):
         if self._verbose:
             self._show(self._horizontal_line())
         self._show(self.SUMMARY, count=count)
+        if self._verbose and cache:
+            self._show(self.CACHE, **cache)
         self._show(self.CLOSING, directory=output)
 
     def _horizontal_line(self):
@@ -129,7 +139,18 @@ class Display:
               "--verbose",
               is_flag=True,
               help='Details what FLaP is doing')
-def main(tex_file, output, verbose):
+@click.option("-s",
+              "--snapshot",
+              type=click.Path(file_okay=True, dir_okay=False),
+              help='Saves (or restores) the preamble into (from) this file')
+@click.option("--speculative",
+              is_flag=True,
+              help='Parses the chapters loaded by \\include in parallel')
+@click.option("-t",
+              "--token-cache",
+              type=click.Path(file_okay=False, dir_okay=True),
+              help='Keeps the lexed tokens in this directory, across runs')
+def main(tex_file, output, verbose, snapshot, speculative, token_cache):
     """FLaP merges your LaTeX projects into a single LaTeX file that
     refers to images in the same directory.
 
@@ -142,7 +163,7 @@ def main(tex_file, output, verbose):
     """
     Controller(OSFileSystem(),
                Display(sys.stdout, verbose))\
-        .run(tex_file, output)
+        .run(tex_file, output, snapshot, speculative, token_cache)
 
 
 # For compatibility with versions prior to 0.2.3
@@ -16,6 +16,11 @@
 #
 
 import os
+import stat
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from flap.util.path import Path, ROOT
 
@@ -46,7 +51,7 @@ class File:
         return self._content == content
 
     def content(self):
-        if not self._content:
+        if self._content is None:
             self._content = self.fileSystem.load(self._path)
         return self._content
 
@@ -148,21 +153,118 @@ class FileSystem:
     def load(self, path):
         pass
 
+    def prefetch(self, path):
+        """Announce that the given file is likely to be loaded soon"""
+        pass
+
+    def cache_statistics(self):
+        """The counters of the content cache, if any"""
+        return None
+
     def move_to_directory(self, path):
         pass
 
 
+class ContentCache:
+    """
+    A least-recently-used cache of file contents, bounded by the total
+    length of the contents it holds. Each content comes with the
+    signature (i.e., modification time and size) of its file, and is
+    only returned while that signature holds.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def holds(self, key, signature):
+        """True if a valid content is cached for the given key. Unlike
+        get, this does not count as a hit or a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] == signature
+
+    def put(self, key, signature, content):
+        with self._lock:
+            self._discard(key)
+            if len(content) > self._capacity:
+                return
+            self._entries[key] = (signature, content)
+            self._size += len(content)
+            while self._size > self._capacity:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    @property
+    def size(self):
+        return self._size
+
+    def statistics(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": self._size}
+
+
 class OSFileSystem(FileSystem):
+    """
+    The file system of the operating system. Contents are cached by
+    resolved path, and checked against the modification time and size
+    of their file on every load. Whether a path is a directory is
+    cached as well, until FLaP writes to the file system.
+
+    Files announced as likely to be loaded are fetched into the cache
+    by a few background threads. Only the contents of TeX sources are
+    read ahead: other files (e.g., images) are merely looked up.
+    """
+
+    CACHE_CAPACITY = 32 * 1024 * 1024
+    PREFETCH_WORKERS = 4
+    SOURCE_EXTENSIONS = ["tex", "sty", "cls"]
 
     def __init__(self):
         super().__init__()
         self.current_directory = Path.fromText(os.getcwd())
+        self._contents = ContentCache(self.CACHE_CAPACITY)
+        self._directories = dict()
+        self._prefetching = set()
+        self._lock = Lock()
+        self._workers = None
 
     @staticmethod
     def for_OS(path):
         return os.path.sep.join([eachPart.fullname()
                                  for eachPart in path.parts()])
 
+    @classmethod
+    def _resolve(cls, path):
+        return os.path.abspath(cls.for_OS(path))
+
     def move_to_directory(self, path):
         os.chdir(self.for_OS(path))
 
@@ -171,20 +273,38 @@ class OSFileSystem(FileSystem):
         os_path = self.for_OS(path)
         with open(os_path, "w") as f:
             f.write(content)
+        self._forget(os_path)
 
     def deleteDirectory(self, path):
         import shutil
         osPath = self.for_OS(path)
         if os.path.exists(osPath):
             shutil.rmtree(osPath)
+        self._forget(osPath)
+
+    def _forget(self, os_path):
+        """Forget what is cached about the given path, which FLaP has
+        just changed"""
+        self._contents.discard(os.path.abspath(os_path))
+        with self._lock:
+            self._directories.clear()
 
     def open(self, path):
         osPath = self.for_OS(path)
-        if os.path.isdir(osPath):
+        if self._is_directory(os.path.abspath(osPath)):
             return Directory(self, path)
         else:
             return File(self, path, None)
 
+    def _is_directory(self, key):
+        with self._lock:
+            is_directory = self._directories.get(key)
+        if is_directory is None:
+            is_directory = os.path.isdir(key)
+            with self._lock:
+                self._directories[key] = is_directory
+        return is_directory
+
     def filesIn(self, path):
         return [self.open(path / each)
                 for each in os.listdir(self.for_OS(path))]
@@ -199,6 +319,7 @@ class OSFileSystem(FileSystem):
             else destination / file.fullname()
 
         shutil.copyfile(source, self.for_OS(target))
+        self._forget(self.for_OS(target))
 
     def _create_path(self, path):
         targetDir = path
@@ -211,9 +332,56 @@ class OSFileSystem(FileSystem):
 
     def load(self, path):
         assert path, "Invalid path (found '%s')" % path
-        os_path = self.for_OS(path)
-        with open(os_path) as file:
-            return file.read()
+        key = self._resolve(path)
+        signature = self._signature_of(os.stat(key))
+        content = self._contents.get(key, signature)
+        if content is None:
+            with open(key) as file:
+                content = file.read()
+            self._contents.put(key, signature, content)
+        return content
+
+    @staticmethod
+    def _signature_of(status):
+        return status.st_mtime_ns, status.st_size
+
+    def cache_statistics(self):
+        return self._contents.statistics()
+
+    def prefetch(self, path):
+        key = self._resolve(path)
+        with self._lock:
+            if key in self._prefetching:
+                return
+            self._prefetching.add(key)
+            if self._workers is None:
+                self._workers = ThreadPoolExecutor(
+                    max_workers=self.PREFETCH_WORKERS,
+                    thread_name_prefix="prefetch")
+        self._workers.submit(self._fetch, key, self._is_a_source(path))
+
+    @classmethod
+    def _is_a_source(cls, path):
+        return any(path.has_extension(each_extension)
+                   for each_extension in cls.SOURCE_EXTENSIONS)
+
+    def _fetch(self, key, with_content):
+        try:
+            status = os.stat(key)
+            is_directory = stat.S_ISDIR(status.st_mode)
+            with self._lock:
+                self._directories[key] = is_directory
+            signature = self._signature_of(status)
+            if with_content and stat.S_ISREG(status.st_mode) \
+                    and not self._contents.holds(key, signature):
+                with open(key) as file:
+                    content = file.read()
+                self._contents.put(key, signature, content)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._prefetching.discard(key)
 
 
 class InMemoryFileSystem(FileSystem):
@@ -244,8 +412,9 @@ class InMemoryFileSystem(FileSystem):
         self.createDirectory(absolute.container())
 
     def filesIn(self, path):
-        return [self.drive[p] for p in self.drive.keys()
-                if p in path and len(p.parts()) == len(path.parts()) + 1]
+        # Iterate over a snapshot, as other threads may add files
+        return [resource for p, resource in list(self.drive.items())
+                if not p.isRoot() and p.container() == path]
 
     def open(self, path):
         absolute = path.absolute_from(self._current_directory)
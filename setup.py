@@ -68,7 +68,8 @@ setup(name='FLaP',
       ],
       tests_require=test_dependencies,
       extras_require={
-          "test": test_dependencies
+          "test": test_dependencies,
+          "vectorised": ["numpy>=1.19"]
       },
       entry_points={
           'console_scripts': [
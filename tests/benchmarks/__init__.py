@@ -0,0 +1,31 @@
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from timeit import repeat
+
+
+def measure(action, runs=5, number=1):
+    """Return the best time, in seconds, among several runs of the
+    given action"""
+    return min(repeat(action, repeat=runs, number=number)) / number
+
+
+def report(title, rows):
+    print(title)
+    for label, seconds in rows:
+        print("  {:<40} {:>10.3f} ms".format(label, seconds * 1000))
@@ -0,0 +1,51 @@
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measure how reading tokens until a given marker scales with the
+number of tokens to read. Run it with:
+
+    $> python -m tests.benchmarks.delimited
+"""
+
+from flap.latex.parser import Factory, Reader
+from flap.latex.symbols import SymbolTable
+from tests.benchmarks import measure, report
+
+
+LINE = "x = a[i] + b[j]; % not a comment\n"
+END = r"\end{verbatim}"
+SIZES = [4000, 8000, 16000, 32000]
+
+
+def read_until_marker(factory, tokens):
+    Reader(list(tokens), factory).until_text(END)
+
+
+def main():
+    factory = Factory(SymbolTable.default())
+    rows = []
+    for size in SIZES:
+        tokens = factory.as_list(LINE) * size + factory.as_list(END)
+        rows.append(("{} lines".format(size),
+                     measure(lambda: read_until_marker(factory, tokens),
+                             runs=3)))
+    report("Reading until a marker", rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measure how macro look-ups scale with the nesting of user-defined
+macros. Run it with:
+
+    $> python -m tests.benchmarks.lookup
+"""
+
+from unittest.mock import MagicMock
+
+from flap.latex.commons import Context
+from flap.latex.macros.factory import MacroFactory
+from flap.latex.parser import Factory, Interpreter
+from flap.latex.symbols import SymbolTable
+from tests.benchmarks import measure, report
+
+
+DEPTHS = [1, 10, 50, 100]
+LOOK_UPS = 10000
+
+
+def nested_scopes(depth):
+    context = Context(definitions=MacroFactory(MagicMock()).all())
+    for level in range(depth):
+        context = Context(context)
+        context["#1"] = []
+    return context
+
+
+def look_ups_in(context):
+    for _ in range(LOOK_UPS):
+        context.look_up("includegraphics")
+        context.look_up("textbf")
+
+
+def nested_macros(depth):
+    """Define \\m0 ... \\mN, where each one invokes the previous one"""
+    factory = Factory(SymbolTable.default())
+    macros = MacroFactory(MagicMock())
+    context = Context(definitions=macros.all())
+    context["m0"] = macros.create_user_defined(
+        "m0", factory.as_list("#1"), factory.as_list(r"{\textbf{#1}}"))
+    for level in range(1, depth):
+        context["m%d" % level] = macros.create_user_defined(
+            "m%d" % level,
+            factory.as_list("#1"),
+            factory.as_list(r"{\m%d{#1}}" % (level - 1)))
+    return factory, context
+
+
+def expand(factory, context, depth):
+    Interpreter(factory.as_tokens(r"\m%d{x}" % (depth - 1), "benchmark"),
+                factory,
+                context).process()
+
+
+def main():
+    report("{} look-ups through nested scopes".format(2 * LOOK_UPS),
+           [("depth = {}".format(depth),
+             measure(lambda: look_ups_in(context)))
+            for depth, context in ((depth, nested_scopes(depth))
+                                   for depth in DEPTHS)])
+    report("Expansion of nested user-defined macros",
+           [("depth = {}".format(depth),
+             measure(lambda: expand(*nested_macros(depth), depth)))
+            for depth in DEPTHS])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measure how reading verbatim content scales with its size. Run it
+with:
+
+    $> python -m tests.benchmarks.verbatim
+"""
+
+from unittest.mock import MagicMock
+
+from flap.latex.commons import Context
+from flap.latex.macros.factory import MacroFactory
+from flap.latex.parser import Factory, Parser
+from flap.latex.symbols import SymbolTable
+from tests.benchmarks import measure, report
+
+
+LINE = "x = a[i] + b[j]; % not a comment\n"
+SIZES = [1000, 4000, 16000, 32000]
+
+
+def verbatim(line_count):
+    return r"\begin{verbatim}" + LINE * line_count + r"\end{verbatim}"
+
+
+def rewrite(text):
+    factory = Factory(SymbolTable.default())
+    context = Context(definitions=MacroFactory(MagicMock()).all())
+    Parser(factory.as_tokens(text, "benchmark"),
+           factory,
+           context).process()
+
+
+def main():
+    report("Rewriting a verbatim environment",
+           [("{} KiB".format(len(text) // 1024),
+             measure(lambda: rewrite(text), runs=1))
+            for text in (verbatim(size) for size in SIZES)])
+
+
+if __name__ == "__main__":
+    main()
@@ -56,6 +56,25 @@ class ClassificationTests(TestCase):
                    r"\foo{my-file}",
                    False)
 
+    def test_expansion_is_only_reported_once(self):
+        self._define(r"foo", "#1", r"{\input{#1}}")
+        parser = self._parse(r"\foo{my-file}")
+        self.assertTrue(parser.shall_expand())
+        self.assertFalse(parser.shall_expand())
+
+    def test_parsers_do_not_share_expansions(self):
+        self._define(r"foo", "#1", r"{\input{#1}}")
+        self._parse(r"\foo{my-file}")
+        self.assertFalse(self._parse(r"no macro").shall_expand())
+
+    def test_macros_hold_no_state_about_expansions(self):
+        self._define(r"foo", "#1", r"{\input{#1}}")
+        self._parse(r"\foo{my-file}")
+        inclusion = self._environment["input"]
+        self.assertEqual({"_flap", "_name", "_signature", "_body",
+                          "is_user_defined"},
+                         set(vars(inclusion)))
+
     def _test(self, macro, invocation, expected_category):
         self._define(*macro)
         self.assertEqual(expected_category,
@@ -69,9 +88,12 @@ class ClassificationTests(TestCase):
         self._environment[name] = macro
 
     def _classify(self, expression):
+        return self._parse(expression).shall_expand()
+
+    def _parse(self, expression):
         parser = Parser(
             self._factory.as_tokens(expression, "Unknown"),
             self._factory,
             self._environment)
         parser.process()
-        return parser.shall_expand()
+        return parser
@@ -20,7 +20,7 @@
 from unittest import TestCase, main
 from unittest.mock import MagicMock
 
-from flap.latex.commons import Stream, Position
+from flap.latex.commons import Stream, Position, TextMatcher
 
 
 class EmptyStreamTest(TestCase):
@@ -76,6 +76,44 @@ class ListStreamTest(TestCase):
         self.assertEqual(expected, "".join(self._stream.take_all()))
 
 
+class TextMatcherTest(TestCase):
+
+    def test_finds_a_marker_split_across_pieces(self):
+        self._verify_matches(r"\end{verbatim}",
+                             ["text", r"\end", "{", "verbatim", "}"],
+                             [False, False, False, False, True])
+
+    def test_finds_a_marker_that_overlaps_a_partial_match(self):
+        self._verify_matches("aab", ["a", "a", "a", "b"],
+                             [False, False, False, True])
+
+    def test_ignores_a_marker_in_the_middle_of_a_piece(self):
+        self._verify_matches("ab", ["xaby", "z", "ab"],
+                             [False, False, True])
+
+    def test_finds_a_marker_at_the_end_of_a_longer_piece(self):
+        self._verify_matches("ab", ["x", "yab"], [False, True])
+
+    def test_empty_markers_match_at_once(self):
+        self._verify_matches("", ["x"], [True])
+
+    def test_skips_a_piece_without_the_marker(self):
+        matcher = TextMatcher("abc")
+        self.assertTrue(matcher.skip("xxab"))
+        self.assertTrue(matcher.feed("c"))
+
+    def test_does_not_skip_a_piece_that_completes_the_marker(self):
+        matcher = TextMatcher("abc")
+        self.assertTrue(matcher.skip("xa"))
+        self.assertFalse(matcher.skip("bcx"))
+        self.assertFalse(matcher.feed("b"))
+        self.assertTrue(matcher.feed("c"))
+
+    def _verify_matches(self, marker, pieces, expected):
+        matcher = TextMatcher(marker)
+        self.assertEqual(expected, [matcher.feed(each) for each in pieces])
+
+
 class PositionTest(TestCase):
 
     def setUp(self):
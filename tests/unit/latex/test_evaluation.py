@@ -50,6 +50,10 @@ class ClassificationTests(TestCase):
         self._define(r"\foo", "#1", "{x=#1}")
         self._verify_evaluation(r"\foo{2}", r"x=2")
 
+    def test_macro_argument_taken_from_a_text_span(self):
+        self._define(r"\foo", "#1.", "{[#1]}")
+        self._verify_evaluation(r"\foo bar.baz", r"[ bar]baz")
+
     def test_nested_macros(self):
         self._define(r"\foo", "#1", r"{\def\bar(#1){bar=#1} \bar(#1)}")
         self._verify_evaluation(r"\foo{2}", r" bar=2")
@@ -59,6 +63,11 @@ class ClassificationTests(TestCase):
         self._define(r"\foo", "#1", r"{File: \input{#1}}")
         self._verify_evaluation(r"\foo{my-file}", "File: blabla")
 
+    def test_macro_that_invoke_input_on_a_group(self):
+        self._engine.content_of.return_value = "{blabla}"
+        self._define(r"\foo", "#1", r"{File: \input{#1}}")
+        self._verify_evaluation(r"\foo{my-file}", "File: blabla")
+
     def test_macro_that_redefines_input(self):
         self._define(r"\foo", "#1", r"{\def\input#1{File: #1}\input{#1}}")
         self._verify_evaluation(r"\foo{test.tex}", "File: test.tex")
@@ -88,6 +97,70 @@ class ClassificationTests(TestCase):
                      r"{\def\bar#1{Bar=#1}\bar#2 ; #1}")
         self._verify_evaluation(r"\foo(2,3)", r"Bar=3 ; 2")
 
+    def test_evaluating_plain_text(self):
+        parser = self._parser_for("")
+        self.assertEqual("img/result.pdf",
+                         parser.evaluate_as_text(
+                             self._factory.as_list("{img/result.pdf}")))
+
+    def test_evaluating_nested_invocations(self):
+        self._define(r"\foo", "#1", "{[#1]}")
+        self._define(r"\bar", "#1", r"{\foo{#1}\foo{#1}}")
+        parser = self._parser_for("")
+        self.assertEqual("[x][x]",
+                         parser.evaluate_as_text(
+                             self._factory.as_list(r"{\bar{x}}")))
+
+    def test_evaluations_reuse_the_same_interpreter(self):
+        self._define(r"\foo", "#1", "{[#1]}")
+        parser = self._parser_for("")
+        interpreter = parser._evaluator
+        parser.evaluate(self._factory.as_list(r"\foo{x}"))
+        parser.evaluate(self._factory.as_list(r"\foo{y}"))
+        self.assertIs(interpreter, parser._evaluator)
+
+    def test_memoising_the_expansion_of_inert_macros(self):
+        self._define(r"\fig", "#1", "{figures/#1}")
+        parser = self._parser_for("")
+        for _ in range(3):
+            self.assertEqual("figures/a.pdf",
+                             parser.evaluate_as_text(
+                                 self._factory.as_list(r"\fig{a.pdf}")))
+        macro = self._environment["fig"]
+        self.assertEqual((2, 1), (macro.hits, macro.misses))
+
+    def test_memoising_expansions_by_arguments(self):
+        self._define(r"\fig", "#1", "{figures/#1}")
+        parser = self._parser_for("")
+        self.assertEqual("figures/a figures/b",
+                         parser.evaluate_as_text(
+                             self._factory.as_list(r"\fig{a} \fig{b}")))
+        self.assertEqual(2, self._environment["fig"].misses)
+
+    def test_not_memoising_arguments_with_commands(self):
+        self._define(r"\fig", "#1", "{figures/#1}")
+        self._define(r"\name", "", "{a}")
+        parser = self._parser_for("")
+        self.assertEqual("figures/a",
+                         parser.evaluate_as_text(
+                             self._factory.as_list(r"\fig{\name}")))
+        macro = self._environment["fig"]
+        self.assertEqual((0, 0), (macro.hits, macro.misses))
+
+    def test_redefinition_discards_memoised_expansions(self):
+        self._define(r"\fig", "#1", "{figures/#1}")
+        parser = self._parser_for("")
+        parser.evaluate(self._factory.as_list(r"\fig{a}"))
+        self._define(r"\fig", "#1", "{images/#1}")
+        self.assertEqual("images/a",
+                         parser.evaluate_as_text(
+                             self._factory.as_list(r"\fig{a}")))
+
+    def _parser_for(self, text):
+        return Parser(self._factory.as_tokens(text, "Unknown"),
+                      self._factory,
+                      self._environment)
+
     # def test_defining_internal_macros(self):
     #     self._symbols.CHARACTER += "@"
     #     self._verify_evaluation(r"\def\internal@foo{\internal@bar}", "")
@@ -18,12 +18,13 @@
 #
 
 
+from tempfile import TemporaryDirectory
 from unittest import TestCase, main
 
 from flap.latex.commons import Position, Source
-from flap.latex.symbols import SymbolTable
+from flap.latex.symbols import Symbol, SymbolTable
 from flap.latex.tokens import TokenFactory
-from flap.latex.lexer import Lexer
+from flap.latex.lexer import Lexer, ScanningRules, TokenCache
 
 
 class LexerTests(TestCase):
@@ -45,11 +46,47 @@ class LexerTests(TestCase):
 
     def test_recognises_a_word(self):
         self._text = "hello"
-        self._verify_tokens(self._tokens.character(Position(1, 1), "h"),
-                            self._tokens.character(Position(1, 2), "e"),
-                            self._tokens.character(Position(1, 3), "l"),
-                            self._tokens.character(Position(1, 4), "l"),
-                            self._tokens.character(Position(1, 5), "o"))
+        self._verify_tokens(self._tokens.text(Position(1, 1), "hello"))
+
+    def test_recognises_words_and_blanks_as_a_single_span(self):
+        self._text = "hello  world!"
+        self._verify_tokens(self._tokens.text(Position(1, 1), "hello  world!"))
+
+    def test_recognises_digits_and_accents_as_a_single_span(self):
+        self._text = "Größe: 12,5 cm\n"
+        self._verify_tokens(
+            self._tokens.text(Position(1, 1), "Größe: 12,5 cm"),
+            self._tokens.new_line(Position(2, 0)))
+
+    def test_recognises_a_single_other_character(self):
+        self._text = "1{"
+        self._verify_tokens(self._tokens.others(Position(1, 1), "1"),
+                            self._tokens.begin_group(Position(1, 2)))
+
+    def test_ends_spans_on_special_characters(self):
+        self._text = "a.b$c"
+        self._verify_tokens(self._tokens.text(Position(1, 1), "a.b"),
+                            self._tokens.math(Position(1, 4)),
+                            self._tokens.character(Position(1, 5), "c"))
+
+    def test_locates_text_spans(self):
+        self._text = "\\foo bar\nbaz"
+        tokens = list(Lexer(self._symbols, Source(self._text)))
+        self.assertEqual([Position(1, 1), Position(1, 5),
+                          Position(2, 0), Position(2, 1)],
+                         [each.location for each in tokens])
+
+    def test_skips_raw_text_up_to_a_marker(self):
+        lexer = Lexer(self._symbols, Source("a{b}\nc%d\\end{x}"))
+        self.assertEqual("a{b}\nc%d", lexer.take_until(r"\end"))
+        self.assertEqual([self._tokens.command(Position(2, 4), r"\end"),
+                          self._tokens.begin_group(Position(2, 8))],
+                         list(lexer)[:2])
+
+    def test_skips_raw_text_up_to_the_end(self):
+        lexer = Lexer(self._symbols, Source("a{b}\nc"))
+        self.assertEqual("a{b}\nc", lexer.take_until(r"\end"))
+        self.assertEqual([], list(lexer))
 
     def test_recognises_a_single_command(self):
         self._text = r"\myMacro"
@@ -137,5 +174,158 @@ class LexerTests(TestCase):
                         self._text))))
 
 
+class TokenCacheTests(TestCase):
+
+    TEXT = r"\def\x{1} \input{table}"
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+        self._cache = TokenCache()
+
+    def _tokens_of(self, text=TEXT, name="table"):
+        return self._cache.tokens_of(name, text, self._symbols)
+
+    def test_gives_the_tokens_of_the_lexer(self):
+        self.assertEqual(
+            list(Lexer(self._symbols, Source.anonymous(self.TEXT))),
+            self._tokens_of())
+
+    def test_lexes_a_file_only_once(self):
+        first = self._tokens_of()
+        second = self._tokens_of()
+
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual((1, 1), (self._cache.hits, self._cache.misses))
+
+    def test_lexes_a_changed_file_again(self):
+        self._tokens_of()
+        self._tokens_of(self.TEXT + " more")
+        self.assertEqual(2, self._cache.misses)
+
+    def test_lexes_again_when_categories_change(self):
+        self._tokens_of()
+        self._symbols.assign("@", Symbol.CHARACTER.value)
+        self._tokens_of()
+        self.assertEqual(2, self._cache.misses)
+
+
+class PersistentTokenCacheTests(TestCase):
+
+    TEXT = r"\def\x{1} \input{table}"
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+        self._directory = TemporaryDirectory()
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _tokens_of(self, text=TEXT):
+        cache = TokenCache(self._directory.name)
+        return cache, cache.tokens_of("table", text, self._symbols)
+
+    def test_loads_the_tokens_packed_by_a_previous_run(self):
+        _, expected = self._tokens_of()
+        cache, actual = self._tokens_of()
+
+        self.assertEqual(expected, actual)
+        self.assertEqual(1, cache.loads)
+
+    def test_lexes_a_changed_file_again(self):
+        self._tokens_of()
+        cache, tokens = self._tokens_of(self.TEXT + " more")
+
+        self.assertEqual(0, cache.loads)
+        self.assertEqual(
+            list(Lexer(self._symbols, Source.anonymous(self.TEXT + " more"))),
+            tokens)
+
+
+class ScanningRulesTests(TestCase):
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+
+    def test_are_shared_by_equal_tables(self):
+        self.assertIs(ScanningRules.of(self._symbols),
+                      ScanningRules.of(SymbolTable.default()))
+
+    def test_differ_between_tables(self):
+        package = self._symbols.clone()
+        package.assign("@", Symbol.CHARACTER.value)
+        self.assertIsNot(ScanningRules.of(self._symbols),
+                         ScanningRules.of(package))
+
+    def test_follow_changes_of_the_table(self):
+        lexer = Lexer(self._symbols, Source(r"\my@title \my@title"))
+        self.assertEqual(r"\my", next(lexer).as_text)
+
+        self._symbols.assign("@", Symbol.CHARACTER.value)
+
+        self.assertEqual("@title ", next(lexer).as_text)
+        self.assertEqual(r"\my@title", next(lexer).as_text)
+
+    def test_evict_the_least_recently_used(self):
+        first = ScanningRules.of(self._symbols)
+        for index in range(ScanningRules.CAPACITY):
+            table = SymbolTable.default()
+            table.assign(chr(ord("0") + index), Symbol.CHARACTER.value)
+            ScanningRules.of(table)
+
+        self.assertEqual(ScanningRules.CAPACITY, ScanningRules.cached())
+        self.assertIsNot(first, ScanningRules.of(self._symbols))
+
+
+class SymbolTableVersionTests(TestCase):
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+
+    def test_changes_on_assignment(self):
+        version = self._symbols.version
+        self._symbols.assign("@", Symbol.CHARACTER.value)
+        self.assertNotEqual(version, self._symbols.version)
+
+    def test_is_shared_by_clones(self):
+        self.assertEqual(self._symbols.version,
+                         self._symbols.clone().version)
+
+    def test_differs_once_a_clone_changes(self):
+        clone = self._symbols.clone()
+        clone.assign("@", Symbol.CHARACTER.value)
+        self.assertNotEqual(self._symbols.version, clone.version)
+
+
+class SymbolTableCopyOnWriteTests(TestCase):
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+
+    def test_clones_share_categories_until_they_change(self):
+        clone = self._symbols.clone()
+        self.assertIs(self._symbols.CHARACTER, clone.CHARACTER)
+
+        clone.assign("@", Symbol.CHARACTER.value)
+
+        self.assertIn("@", clone.CHARACTER)
+        self.assertNotIn("@", self._symbols.CHARACTER)
+
+    def test_originals_do_not_change_their_clones(self):
+        clone = self._symbols.clone()
+        self._symbols.assign("@", Symbol.CHARACTER.value)
+        self.assertNotIn("@", clone.CHARACTER)
+
+    def test_fingerprints_describe_categories(self):
+        other = SymbolTable.default()
+        self.assertEqual(self._symbols.fingerprint, other.fingerprint)
+
+        other.assign("@", Symbol.CHARACTER.value)
+        self.assertNotEqual(self._symbols.fingerprint, other.fingerprint)
+
+        other.assign("@", Symbol.OTHERS.value)
+        self.assertEqual(self._symbols.fingerprint, other.fingerprint)
+
+
 if __name__ == "__main__":
     main()
@@ -19,7 +19,11 @@
 
 from unittest import TestCase, main
 
-from flap.latex.macros.commons import Invocation
+from unittest.mock import MagicMock
+
+from flap.latex.symbols import SymbolTable
+from flap.latex.parser import Factory
+from flap.latex.macros.commons import Invocation, UserDefinedMacro
 
 
 class InvocationTests(TestCase):
@@ -81,6 +85,59 @@ class InvocationTests(TestCase):
         self._invocation.append_argument("link", ["p1", ",", "p2"])
         self.assertEqual([r"\foo"], self._invocation.name)
 
+    def test_token_view_is_computed_once(self):
+        self._invocation.name = [r"\foo"]
+        self._invocation.append_argument("link", ["{", "a", "}"])
+        self.assertIs(self._invocation.as_tokens, self._invocation.as_tokens)
+
+    def test_views_follow_appended_arguments(self):
+        self._invocation.name = [r"\foo"]
+        self._invocation.append_argument("options", ["[", "a", "]"])
+        self.assertEqual(r"\foo[a]", self._invocation.as_text)
+        self._invocation.append_argument("link", ["{", "b", "}"])
+        self.assertEqual(r"\foo[a]{b}", self._invocation.as_text)
+        self.assertEqual(7, len(self._invocation.as_tokens))
+
+    def test_views_follow_renaming(self):
+        self._invocation.name = [r"\foo"]
+        self._invocation.append_argument("link", ["{", "a", "}"])
+        self.assertEqual(r"\foo{a}", self._invocation.as_text)
+        self._invocation.name = [r"\bar"]
+        self.assertEqual(r"\bar{a}", self._invocation.as_text)
+
+    def test_substitution_leaves_the_original_views_unchanged(self):
+        self._invocation.name = [r"\foo"]
+        self._invocation.append_argument("link", ["{", "a", "}"])
+        self.assertEqual(r"\foo{a}", self._invocation.as_text)
+        clone = self._invocation.substitute("link", ["{", "b", "}"])
+        self.assertEqual(r"\foo{b}", clone.as_text)
+        self.assertEqual(r"\foo{a}", self._invocation.as_text)
+
+
+class UserDefinedMacroTests(TestCase):
+
+    def setUp(self):
+        self._factory = Factory(SymbolTable.default())
+
+    def _macro(self, body):
+        return UserDefinedMacro(MagicMock(), r"\foo",
+                                self._factory.as_list("#1#2"),
+                                self._factory.as_list(body))
+
+    def test_a_body_without_command_is_inert(self):
+        self.assertTrue(self._macro("{#1, and #2}").is_inert)
+
+    def test_a_body_with_commands_is_not_inert(self):
+        self.assertFalse(self._macro(r"{\textbf{#1}}").is_inert)
+
+    def test_expanding_an_inert_body(self):
+        interpreter = MagicMock()
+        interpreter.look_up.side_effect = lambda name: [name]
+        interpreter.evaluate.side_effect = lambda tokens: tokens
+        self.assertEqual("[#1, and #2]",
+                         "".join(map(str, self._macro("{[#1, and {#2}]}")
+                                     .expand_with(interpreter))))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import pickle
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from flap.latex.commons import Source
+from flap.latex.lexer import Lexer
+from flap.latex.packing import InvalidPack, PackedTokens
+from flap.latex.symbols import Symbol, SymbolTable
+
+
+class PackedTokensTests(TestCase):
+
+    TEXT = ("\\documentclass{article}\n"
+            "% Größe: 12,5 cm\n"
+            "\\def\\point#1#2{(#1, #2)}\n"
+            "\\begin{document}\n"
+            "  $x^2_i$~and \\point{1}{2}.\n"
+            "\n"
+            "\\end{document}")
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+
+    def _lex(self, text=TEXT, name="main.tex"):
+        return list(Lexer(self._symbols, Source.with_name(text, name)))
+
+    def _verify_round_trip(self, text):
+        tokens = self._lex(text)
+        packed = PackedTokens.pack(tokens, text, "main.tex")
+
+        unpacked = PackedTokens.unpack(packed, text, self._symbols)
+
+        self.assertEqual(tokens, unpacked)
+        self.assertEqual([(each.location.line,
+                           each.location.column,
+                           each.location.source) for each in tokens],
+                         [(each.location.line,
+                           each.location.column,
+                           each.location.source) for each in unpacked])
+        self.assertEqual([type(each) for each in tokens],
+                         [type(each) for each in unpacked])
+
+    def test_round_trip(self):
+        self._verify_round_trip(self.TEXT)
+
+    def test_round_trip_on_empty_text(self):
+        self._verify_round_trip("")
+
+    def test_round_trip_on_long_lines(self):
+        self._verify_round_trip(("word " * 20000 + "\\foo ") * 3)
+
+    def test_round_trip_with_other_categories(self):
+        self._symbols.assign("@", Symbol.CHARACTER.value)
+        self._verify_round_trip("\\my@macro{@}")
+
+    def test_is_smaller_than_pickled_tokens(self):
+        tokens = self._lex()
+        packed = PackedTokens.pack(tokens, self.TEXT, "main.tex")
+        self.assertLess(5 * len(packed), len(pickle.dumps(tokens)))
+
+    def test_rejects_another_text(self):
+        packed = PackedTokens.pack(self._lex(), self.TEXT, "main.tex")
+        with self.assertRaises(InvalidPack):
+            PackedTokens.unpack(packed, self.TEXT + " ", self._symbols)
+
+    def test_rejects_truncated_packs(self):
+        packed = PackedTokens.pack(self._lex(), self.TEXT, "main.tex")
+        with self.assertRaises(InvalidPack):
+            PackedTokens.unpack(packed[:-8], self.TEXT, self._symbols)
+
+    def test_rejects_corrupted_packs(self):
+        packed = bytearray(
+            PackedTokens.pack(self._lex(), self.TEXT, "main.tex"))
+        packed[PackedTokens.HEADER.size + len("main.tex")] = ord("z")
+        with self.assertRaises(InvalidPack):
+            PackedTokens.unpack(packed, self.TEXT, self._symbols)
+
+    def test_rejects_tokens_that_do_not_cover_the_text(self):
+        with self.assertRaises(InvalidPack):
+            PackedTokens.pack(self._lex(), self.TEXT + "\n", "main.tex")
+
+    def test_loads_memory_mapped_files(self):
+        tokens = self._lex()
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "main.tok")
+            PackedTokens.save(path, tokens, self.TEXT, "main.tex")
+
+            self.assertEqual(tokens,
+                             PackedTokens.load(path, self.TEXT, self._symbols))
+            with self.assertRaises(InvalidPack):
+                PackedTokens.load(path, "", self._symbols)
+
+    def test_replaces_existing_packs_rather_than_rewriting_them(self):
+        tokens = self._lex()
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "main.tok")
+            PackedTokens.save(path, tokens, self.TEXT, "main.tex")
+            with open(path, "rb") as previous:
+                PackedTokens.save(path, tokens, self.TEXT, "main.tex")
+                self.assertNotEqual(os.fstat(previous.fileno()).st_ino,
+                                    os.stat(path).st_ino)
+                self.assertEqual(os.path.getsize(path),
+                                 len(previous.read()))
+            self.assertEqual(["main.tok"], os.listdir(directory))
+
+
+if __name__ == "__main__":
+    main()
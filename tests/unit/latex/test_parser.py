@@ -23,7 +23,7 @@ from unittest.mock import MagicMock, ANY
 from flap.latex.symbols import SymbolTable
 from flap.latex.tokens import TokenFactory
 from flap.latex.macros.factory import MacroFactory
-from flap.latex.parser import Parser, Context, Factory
+from flap.latex.parser import Parser, Reader, Context, Factory
 
 
 class ContextTest(TestCase):
@@ -49,11 +49,59 @@ class ContextTest(TestCase):
             self.assertTrue(key in self._environment)
             self.assertEqual(value, self._environment[key])
 
+    def test_nested_scope_sees_enclosing_definitions(self):
+        scope = Context(self._environment)
+        self.assertEqual(1, scope.look_up("Z"))
+
+    def test_nested_scope_sees_later_enclosing_definitions(self):
+        scope = Context(Context(self._environment))
+        self.assertIsNone(scope.look_up("X"))
+        self._environment["X"] = 2
+        self.assertEqual(2, scope.look_up("X"))
+
+    def test_nested_scope_shadows_enclosing_definitions(self):
+        scope = Context(self._environment)
+        self.assertEqual(1, scope.look_up("Z"))
+        scope["Z"] = []
+        self.assertEqual([], scope.look_up("Z"))
+        self.assertEqual(1, self._environment.look_up("Z"))
+
+    def test_closing_a_scope_restores_shadowed_definitions(self):
+        scope = Context(self._environment)
+        scope["Z"] = 2
+        self.assertIs(self._environment, scope.close())
+        self.assertEqual(1, self._environment.look_up("Z"))
+
+    def test_closed_scope_still_resolves_its_definitions(self):
+        scope = Context(self._environment)
+        scope["Z"] = 2
+        scope.close()
+        self.assertEqual(2, scope.look_up("Z"))
+        self.assertEqual(1, self._environment.look_up("Z"))
+
+    def test_opening_a_sibling_scope_hides_the_previous_one(self):
+        first = Context(self._environment)
+        first["X"] = 2
+        second = Context(self._environment)
+        self.assertIsNone(second.look_up("X"))
+        self.assertEqual(2, first.look_up("X"))
+
+    def test_defining_in_a_scope_enclosing_the_innermost_one(self):
+        outer = Context(self._environment)
+        inner = Context(outer)
+        inner["X"] = 3
+        outer["X"] = 2
+        self.assertEqual(3, inner.look_up("X"))
+        self.assertEqual(2, outer.look_up("X"))
+        inner.close()
+        self.assertEqual(2, outer.look_up("X"))
+
 
 class ParserTests(TestCase):
 
     def setUp(self):
         self._engine = MagicMock()
+        self._engine.speculate.return_value = None
         self._macros = MacroFactory(self._engine)
         self._symbols = SymbolTable.default()
         self._tokens = TokenFactory(self._symbols)
@@ -79,6 +127,10 @@ class ParserTests(TestCase):
         output = "".join(str(t) for t in actual_tokens)
         self.assertEqual(expected_text, output)
 
+    def test_parsing_prose(self):
+        self._do_test_with("Some prose, with punctuation.\n  And more!",
+                           "Some prose, with punctuation.\n  And more!")
+
     def test_rewriting_a_group(self):
         self._do_test_with("{bonjour}",
                            "{bonjour}")
@@ -101,6 +153,67 @@ class ParserTests(TestCase):
                            r"\begin{verbatim}\input{bar}\end{verbatim}")
         self._engine.content_of.assert_not_called()
 
+    def test_reading_a_verbatim_environment_as_a_single_token(self):
+        tokens = self._process(r"\begin{verbatim}\foo{bar} baz"
+                               "\n\\end{verbatim}")
+        self.assertEqual([r"\foo{bar} baz" "\n"],
+                         [str(each) for each in tokens
+                          if each.is_raw_text])
+
+    def test_rewriting_an_unterminated_verbatim_environment(self):
+        self._do_test_with(r"\begin{verbatim}\input{bar}",
+                           r"\begin{verbatim}\input{bar}")
+
+    def test_rewriting_a_verbatim_environment_given_as_tokens(self):
+        self._engine.content_of.return_value = "blabla"
+        text = r"\begin{verbatim}\input{bar}\end{verbatim}\input{foo}"
+        parser = Parser(self._factory.as_list(text),
+                        self._factory,
+                        self._environment)
+        self._verify_output_is(
+            r"\begin{verbatim}\input{bar}\end{verbatim}blabla",
+            parser.process())
+
+    def test_rewriting_a_input_in_a_listing(self):
+        self._engine.content_of.return_value = "blabla"
+        self._do_test_with(r"\begin{lstlisting}[language=TeX]"
+                           r"\input{bar}\end{lstlisting}",
+                           r"\begin{lstlisting}[language=TeX]"
+                           r"\input{bar}\end{lstlisting}")
+        self._engine.content_of.assert_not_called()
+
+    def test_rewriting_a_input_in_a_comment(self):
+        self._engine.content_of.return_value = "blabla"
+        self._do_test_with(r"\begin{comment}\input{bar}\end{comment}",
+                           r"\begin{comment}\input{bar}\end{comment}")
+        self._engine.content_of.assert_not_called()
+
+    def test_rewriting_a_input_in_a_declared_raw_environment(self):
+        self._engine.content_of.return_value = "blabla"
+        self._macros.declare_raw_environment("code")
+        self._environment = Context(definitions=self._macros.all())
+        self._do_test_with(r"\begin{code}\input{bar}\end{code}",
+                           r"\begin{code}\input{bar}\end{code}")
+        self._engine.content_of.assert_not_called()
+
+    def test_reading_arguments_with_a_single_reader(self):
+        parser = Parser(self._factory.as_tokens("{a}[b]{c}", "Unknown"),
+                        self._factory,
+                        self._environment)
+        reader = parser.read
+        first = parser.read.group()
+        options = parser.read.options()
+        last = parser.read.group()
+        self.assertIs(reader, parser.read)
+        self.assertEqual(["{a}", "[b]", "{c}"],
+                         ["".join(str(each) for each in tokens)
+                          for tokens in (first, options, last)])
+
+    def _process(self, text):
+        return Parser(self._factory.as_tokens(text, "Unknown"),
+                      self._factory,
+                      self._environment).process()
+
     def test_rewriting_a_unknown_environment(self):
         self._do_test_with(r"\begin{center}blabla\end{center}",
                            r"\begin{center}blabla\end{center}")
@@ -158,6 +271,22 @@ class ParserTests(TestCase):
                            r"File content")
         self._engine.content_of.assert_called_once_with("my-file", ANY)
 
+    def test_rewriting_input_of_a_file_with_nothing_to_rewrite(self):
+        self._engine.content_of.return_value = r"Some \textbf{bold} text"
+        self._do_test_with(r"\input{my-file} and more",
+                           r"Some \textbf{bold} text and more")
+
+    def test_rewriting_input_of_a_file_with_commands_to_rewrite(self):
+        self._engine.content_of.side_effect = [r"A \input{other}", "B"]
+        self._do_test_with(r"\input{my-file}", r"A B")
+
+    def test_reading_a_group_out_of_a_raw_text(self):
+        parser = Parser([self._factory.as_raw_text("{img/result.pdf} more")],
+                        self._factory,
+                        self._environment)
+        self._verify_output_is("{img/result.pdf}", parser.read.group())
+        self._verify_output_is(" more", parser.process())
+
     def test_rewriting_multiline_commands(self):
         self._engine.update_link_to_graphic.return_value = "img_result"
         self._do_test_with("\\includegraphics % \n" +
@@ -200,6 +329,17 @@ class ParserTests(TestCase):
         self._engine.shall_include.assert_called_once_with("my-file")
         self._engine.content_of.assert_called_once_with("my-file", ANY)
 
+    def test_rewriting_include_speculatively(self):
+        self._engine.shall_include.return_value = True
+        self._engine.speculate.return_value = \
+            self._factory.as_deferred_text(lambda: "Chapter", None)
+
+        self._do_test_with(r"\include{my-file}",
+                           r"Chapter\clearpage")
+
+        self._engine.speculate.assert_called_once_with("my-file", ANY, ANY)
+        self._engine.content_of.assert_not_called()
+
     def test_rewriting_include_when_the_file_shall_not_be_included(self):
         self._engine.shall_include.return_value = False
         self._engine.content_of.return_value = "File content"
@@ -313,5 +453,157 @@ class ParserTests(TestCase):
         )
 
 
+class PreScanTests(TestCase):
+
+    def setUp(self):
+        self._macros = MacroFactory(MagicMock())
+        self._factory = Factory(SymbolTable.default())
+        self._environment = Context(definitions=self._macros.all())
+        self._parser = Parser([], self._factory, self._environment)
+
+    def test_plain_text(self):
+        self._verify_no_rewriting_in("Some plain text, with no command")
+
+    def test_unknown_commands(self):
+        self._verify_no_rewriting_in(r"Some \textbf{bold} text\\")
+
+    def test_unknown_environments(self):
+        self._verify_no_rewriting_in(r"\begin{center}text\end{center}")
+
+    def test_known_commands(self):
+        self._verify_rewriting_in(r"Some \input{file}")
+
+    def test_macro_definitions(self):
+        self._verify_rewriting_in(r"\def\foo{bar}")
+
+    def test_user_defined_macros(self):
+        self._environment["foo"] = self._macros.create_user_defined(
+            "foo", [], [])
+        self._verify_rewriting_in(r"Text \foo.")
+
+    def test_known_environments(self):
+        self._verify_rewriting_in(r"\begin{verbatim}\end{verbatim}")
+
+    def test_ambiguous_environments(self):
+        self._verify_rewriting_in(r"\begin {center}\end{center}")
+
+    def test_parameters(self):
+        self._verify_rewriting_in(r"Text #1")
+
+    def _verify_no_rewriting_in(self, text):
+        self.assertFalse(self._parser.needs_rewriting(text))
+
+    def _verify_rewriting_in(self, text):
+        self.assertTrue(self._parser.needs_rewriting(text))
+
+
+class DelimitedReadingTests(TestCase):
+
+    END = r"\end{verbatim}"
+
+    def setUp(self):
+        self._factory = Factory(SymbolTable.default())
+
+    def test_reading_until_a_marker(self):
+        reader = self._reader_for(r"some \verb|text|\end{verbatim}rest")
+        self.assertEqual(r"some \verb|text|\end{verbatim",
+                         self._text(reader.until_text(self.END)))
+
+    def test_reading_until_a_marker_including_it(self):
+        reader = self._reader_for(r"some text\end{verbatim}rest")
+        self.assertEqual(r"some text\end{verbatim}",
+                         self._text(reader.until_text(self.END, True)))
+
+    def test_reading_until_a_marker_that_is_never_found(self):
+        reader = self._reader_for("some text")
+        self.assertEqual("some text",
+                         self._text(reader.until_text(self.END)))
+
+    def test_reading_until_a_marker_within_a_text_span(self):
+        reader = self._reader_for("a, b] c")
+        self.assertEqual("a, b", self._text(reader.until_text("]")))
+        self.assertEqual("] c", self._text(reader._tokens.take_all()))
+
+    def test_reading_a_given_text(self):
+        reader = self._reader_for("to: x")
+        self.assertEqual("to:", self._text(reader.text("to:")))
+
+    def test_reading_a_text_that_differs(self):
+        reader = self._reader_for("tx: x")
+        self.assertEqual("t", self._text(reader.text("to:")))
+
+    def test_reading_raw_text_until_a_marker(self):
+        reader = self._reader_for(r"some \verb|text|\end{verbatim}rest")
+        tokens = reader.raw_until(self.END)
+        self.assertEqual(r"some \verb|text|", str(tokens[0]))
+        self.assertEqual(self.END, self._text(tokens[1:]))
+        self.assertEqual("rest", self._text(reader._tokens.take_all()))
+
+    def test_reading_raw_text_after_looking_ahead(self):
+        reader = self._reader_for(r"a\end{verbatim}rest")
+        reader.text("a")
+        tokens = reader.raw_until(self.END)
+        self.assertEqual(self.END, self._text(tokens))
+        self.assertEqual("rest", self._text(reader._tokens.take_all()))
+
+    def test_reading_raw_text_from_tokens(self):
+        reader = Reader(self._factory.as_list(r"a \b\end{verbatim}c"),
+                        self._factory)
+        tokens = reader.raw_until(self.END)
+        self.assertEqual(r"a \b", str(tokens[0]))
+        self.assertEqual(self.END, self._text(tokens[1:]))
+        self.assertEqual("c", self._text(reader._tokens.take_all()))
+
+    def _reader_for(self, text):
+        return Reader(self._factory.as_tokens(text, "Unknown"),
+                      self._factory)
+
+    @staticmethod
+    def _text(tokens):
+        return "".join(str(each) for each in tokens)
+
+
+class GroupReadingTests(TestCase):
+
+    DEPTH = 20000
+
+    def setUp(self):
+        self._factory = Factory(SymbolTable.default())
+
+    def test_reading_a_group(self):
+        self._verify_group("{a {b} c}", "{a {b} c} d")
+
+    def test_reading_a_group_keeps_text_spans_whole(self):
+        reader = self._reader_for("{Größe: 12,5 cm}")
+        self.assertEqual(3, len(reader.group()))
+
+    def test_reading_an_unterminated_group(self):
+        self._verify_group("{a {b} c", "{a {b} c")
+
+    def test_reading_deeply_nested_groups(self):
+        group = "{" * self.DEPTH + "x" + "}" * self.DEPTH
+        self._verify_group(group, group + "y")
+
+    def test_reading_deeply_nested_groups_after_a_macro(self):
+        macros = MacroFactory(MagicMock())
+        environment = Context(definitions=macros.all())
+        environment["foo"] = macros.create_user_defined(
+            "foo", self._factory.as_list("#1"), self._factory.as_list("#1"))
+        text = r"\foo" + "{" * self.DEPTH + "x" + "}" * self.DEPTH
+        tokens = Parser(self._factory.as_tokens(text, "Unknown"),
+                        self._factory,
+                        environment).process()
+        self.assertEqual(text, "".join(str(each) for each in tokens))
+
+    def _reader_for(self, text):
+        return Reader(self._factory.as_tokens(text, "Unknown"),
+                      self._factory)
+
+    def _verify_group(self, expected, text):
+        reader = self._reader_for(text)
+        self.assertEqual(expected,
+                         "".join(str(each) for each in reader.group()))
+
+
 if __name__ == '__main__':
     main()
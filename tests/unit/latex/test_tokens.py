@@ -62,5 +62,41 @@ class TokenTests(TestCase):
                 self._token))
 
 
+class TextSpanTests(TestCase):
+
+    def setUp(self):
+        self._tokens = TokenFactory(SymbolTable.default())
+
+    def test_split_detaches_a_single_letter(self):
+        head, rest = self._tokens.text(Position(1, 1), "ab c").split()
+        self.assertEqual(self._tokens.character(Position(1, 1), "a"), head)
+        self.assertEqual(self._tokens.text(Position(1, 2), "b c"), rest)
+        self.assertEqual(Position(1, 2), rest.location)
+
+    def test_split_detaches_all_leading_blanks(self):
+        head, rest = self._tokens.text(Position(1, 1), "  \tab").split()
+        self.assertEqual(
+            self._tokens.white_space(Position(1, 1), "  \t"), head)
+        self.assertEqual(self._tokens.text(Position(1, 4), "ab"), rest)
+        self.assertEqual(Position(1, 4), rest.location)
+
+    def test_split_the_last_letter(self):
+        head, rest = self._tokens.text(Position(1, 1), "a").split()
+        self.assertEqual(self._tokens.character(Position(1, 1), "a"), head)
+        self.assertIsNone(rest)
+
+    def test_split_detaches_a_single_other_character(self):
+        head, rest = self._tokens.text(Position(1, 1), "[a]").split()
+        self.assertEqual(self._tokens.others(Position(1, 1), "["), head)
+        self.assertEqual(self._tokens.text(Position(1, 2), "a]"), rest)
+
+    def test_tokens_of_a_span(self):
+        self.assertEqual([self._tokens.character(Position(1, 1), "a"),
+                          self._tokens.others(Position(1, 2), "1"),
+                          self._tokens.white_space(Position(1, 3), "  "),
+                          self._tokens.others(Position(1, 5), "é")],
+                         self._tokens.text(Position(1, 1), "a1  é").tokens())
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from unittest import TestCase, main, skipUnless
+from mock import patch
+
+from flap.latex.commons import Source
+from flap.latex.lexer import Lexer
+from flap.latex.symbols import Symbol, SymbolTable
+from flap.latex.vectorised import VectorisedLexer
+
+
+@skipUnless(VectorisedLexer.is_available(), "NumPy is not installed")
+class VectorisedLexerTests(TestCase):
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+
+    def _verify_same_as_lexer(self, text):
+        source = Source.with_name(text, "table.tex")
+        expected = list(Lexer(self._symbols, source))
+
+        actual = VectorisedLexer(self._symbols, source).tokens()
+
+        self.assertEqual(expected, actual)
+        self.assertEqual([(type(each), each.location.line,
+                           each.location.column, each.location.source)
+                          for each in expected],
+                         [(type(each), each.location.line,
+                           each.location.column, each.location.source)
+                          for each in actual])
+
+    def test_empty_text(self):
+        self._verify_same_as_lexer("")
+
+    def test_text_spans(self):
+        self._verify_same_as_lexer("Größe: 12,5 cm  \t a b")
+
+    def test_commands(self):
+        self._verify_same_as_lexer("\\foo\\bar{x}\\\\\\%\\\n\\1 \\end")
+
+    def test_comments(self):
+        self._verify_same_as_lexer("a % comment\n% other\n%")
+
+    def test_special_characters(self):
+        self._verify_same_as_lexer("$x^2_i$~#1#23{}\n\n \n")
+
+    def test_tables(self):
+        row = "\\textbf{%d} & 3.14 & $x^2$ & words \\\\ %% row\n"
+        self._verify_same_as_lexer("".join(row % index
+                                           for index in range(500)))
+
+    def test_other_letters(self):
+        self._symbols.assign("@", Symbol.CHARACTER.value)
+        self._verify_same_as_lexer("\\my@macro{@} @")
+
+    def test_large_sources_are_vectorised(self):
+        text = "\\hline 1 & 2 \\\\\n" * (VectorisedLexer.THRESHOLD // 10)
+        with patch.object(VectorisedLexer, "tokens",
+                          autospec=True,
+                          side_effect=VectorisedLexer.tokens) as tokens:
+            Lexer.tokens_of(self._symbols, Source(text))
+        tokens.assert_called_once()
+
+
+class FallbackTests(TestCase):
+
+    TEXT = "\\hline 1 & 2 \\\\\n"
+
+    def setUp(self):
+        self._symbols = SymbolTable.default()
+        self._source = Source(
+            self.TEXT * (VectorisedLexer.THRESHOLD // len(self.TEXT) + 1))
+
+    def _verify_falls_back(self):
+        self.assertFalse(VectorisedLexer.applies_to(self._symbols,
+                                                    self._source))
+        self.assertEqual(list(Lexer(self._symbols, self._source)),
+                         Lexer.tokens_of(self._symbols, self._source))
+
+    def test_without_numpy(self):
+        with patch("flap.latex.vectorised.numpy", None):
+            self._verify_falls_back()
+
+    def test_on_small_sources(self):
+        self._source = Source(self.TEXT)
+        self._verify_falls_back()
+
+    def test_on_unsupported_categories(self):
+        self._symbols[Symbol.ALIGNMENT_TAB] = ["&"]
+        self.assertFalse(VectorisedLexer.supports(self._symbols))
+
+
+if __name__ == "__main__":
+    main()
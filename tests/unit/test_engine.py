@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from tempfile import TemporaryDirectory
+from threading import Barrier, Event
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from flap.engine import Lookahead, Run, Settings, TexFileNotFound
+from flap.latex.parser import Parser
+from flap.latex.symbols import Symbol
+from flap.ui import Display
+from flap.util.oofs import InMemoryFileSystem
+from flap.util.path import Path
+
+
+class ConcurrentFlatteningTests(TestCase):
+
+    PROJECT_COUNT = 8
+    RUN_COUNT = 48
+
+    MAIN = ("\\documentclass{article}\n"
+            "\\usepackage{macros}\n"
+            "\\graphicspath{{img/}}\n"
+            "\\def\\project#1{Project #1}\n"
+            "\\begin{document}\n"
+            "\\input{sections/intro}\n"
+            "\\begin{verbatim}\\input{not-this}\\end{verbatim}\n"
+            "\\end{document}\n")
+
+    PACKAGE = ("\\catcode`\\@=11\n"
+               "\\def\\my@title#1{\\textbf{#1}}\n"
+               "\\RequirePackage{other}\n")
+
+    def setUp(self):
+        self._file_system = InMemoryFileSystem()
+        for index in range(self.PROJECT_COUNT):
+            self._create_project(index)
+
+    def _create_project(self, index):
+        files = {
+            "main.tex": self.MAIN,
+            "macros.sty": self.PACKAGE,
+            "other.sty": "%% Package %d" % index,
+            "sections/intro.tex":
+                "\\project{%d}: \\includegraphics{plot}\n" % index,
+            "img/plot.pdf": "PDF %d" % index
+        }
+        for path, content in files.items():
+            self._file_system.create_file(
+                self._project(index) / path, content)
+
+    @staticmethod
+    def _project(index):
+        return Path.fromText("/projects/p%d" % index)
+
+    @staticmethod
+    def _output(run):
+        return Path.fromText("/outputs/run%d" % run)
+
+    def _flatten(self, run):
+        display = StringIO()
+        count = self._settings(run, display).execute().count
+        return count, display.getvalue(), self._outputs_of(run)
+
+    def _settings(self, run, display):
+        project = run % self.PROJECT_COUNT
+        return Settings(
+            self._file_system,
+            Display(display, verbose=True),
+            root_tex_file=str(self._project(project) / "main.tex"),
+            output=str(self._output(run)))
+
+    def _outputs_of(self, run):
+        directory = self._file_system.open(self._output(run))
+        return {each.fullname(): each.content()
+                for each in directory.files()}
+
+    def test_concurrent_runs_match_sequential_ones(self):
+        expected = [self._flatten(run)
+                    for run in range(self.PROJECT_COUNT)]
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(self._flatten,
+                                        range(self.RUN_COUNT)))
+
+        for run, result in enumerate(results):
+            self.assertEqual(expected[run % self.PROJECT_COUNT], result)
+
+    def test_settings_can_be_executed_again(self):
+        settings = self._settings(0, StringIO())
+
+        first = settings.execute()
+        second = settings.execute()
+
+        self.assertEqual(first.count, second.count)
+        self.assertEqual("% Package 0",
+                         self._outputs_of(0)["other.sty"])
+
+
+class DependencyRewritingTests(TestCase):
+
+    def setUp(self):
+        self._file_system = InMemoryFileSystem()
+        self._display = MagicMock()
+
+    def _create(self, path, content):
+        self._file_system.create_file(Path.fromText("/project/" + path),
+                                      content)
+
+    def _execute(self):
+        return Settings(self._file_system,
+                        self._display,
+                        root_tex_file="/project/main.tex",
+                        output="/output").execute()
+
+    def _shown_sources(self):
+        return [each_call.kwargs["file"]
+                for each_call in self._display.entry.call_args_list]
+
+    def test_modifications_are_shown_in_sequential_order(self):
+        self._create("main.tex",
+                     "\\usepackage{first}\n"
+                     "\\usepackage{second}\n"
+                     "\\input{body}\n")
+        self._create("first.sty", "\\RequirePackage{third}\n")
+        self._create("second.sty", "\\input{definitions}\n")
+        self._create("third.sty", "Third\n")
+        self._create("body.tex", "Body\n")
+        self._create("definitions.tex", "Definitions\n")
+
+        run = self._execute()
+
+        self.assertEqual(5, run.count)
+        self.assertEqual(["main.tex", "first.sty", "main.tex",
+                          "second.sty", "main.tex"],
+                         self._shown_sources())
+
+    def test_dependencies_use_the_categories_set_when_required(self):
+        self._create("main.tex", "\\usepackage{pkg}\n")
+        self._create("pkg.sty", "% \\input{body}\n")
+        self._create("body.tex", "Body\n")
+
+        parsed = Event()
+        rewrite_dependency = Run._rewrite_dependency
+        wait_for_dependencies = Run._wait_for_dependencies
+
+        def rewrite_once_parsed(*arguments):
+            parsed.wait(5)
+            return rewrite_dependency(*arguments)
+
+        def release_and_wait(run):
+            run.set_character_category("%", Symbol.OTHERS.value)
+            parsed.set()
+            return wait_for_dependencies(run)
+
+        with patch.object(Run, "_rewrite_dependency", rewrite_once_parsed), \
+                patch.object(Run, "_wait_for_dependencies", release_and_wait):
+            self._execute()
+
+        self.assertEqual("% \\input{body}\n",
+                         self._file_system.open(
+                             Path.fromText("/output/pkg.sty")).content())
+
+    def test_errors_in_dependencies_are_raised(self):
+        self._create("main.tex", "\\usepackage{faulty}\n")
+        self._create("faulty.sty", "\\input{missing}\n")
+
+        with self.assertRaises(TexFileNotFound):
+            self._execute()
+
+
+class SpeculativeFlatteningTests(TestCase):
+
+    def setUp(self):
+        self._file_system = InMemoryFileSystem()
+
+    def _create(self, path, content):
+        self._file_system.create_file(Path.fromText("/project/" + path),
+                                      content)
+
+    def _execute(self, speculative):
+        display = MagicMock()
+        output = "/speculative" if speculative else "/sequential"
+        run = Settings(self._file_system,
+                       display,
+                       root_tex_file="/project/main.tex",
+                       output=output,
+                       speculative=speculative).execute()
+        merged = self._file_system.open(Path.fromText(output + "/merged.tex"))
+        return run, merged.content(), display.entry.call_args_list
+
+    def _verify_same_as_sequential(self, is_speculative):
+        run, *expected = self._execute(speculative=False)
+        run, *actual = self._execute(speculative=True)
+        self.assertEqual(is_speculative, run.is_speculative)
+        self.assertEqual(expected, actual)
+
+    def test_chapters_that_change_nothing(self):
+        self._create("main.tex",
+                     "\\def\\name{World}\n"
+                     "\\include{one}\n"
+                     "\\include{two}\n"
+                     "\\input{end}\n")
+        self._create("one.tex", "Hello \\name! \\input{nested}")
+        self._create("nested.tex", "Nested")
+        self._create("two.tex", "\\includegraphics{plot}")
+        self._create("plot.pdf", "PDF")
+        self._create("end.tex", "The end")
+
+        self._verify_same_as_sequential(is_speculative=True)
+
+    def test_chapters_that_define_macros(self):
+        self._create("main.tex",
+                     "\\include{one}\n"
+                     "\\include{two}\n")
+        self._create("one.tex", "\\def\\name{World}")
+        self._create("two.tex", "Hello \\name!")
+
+        self._verify_same_as_sequential(is_speculative=False)
+
+    def test_chapters_that_change_the_graphics_path(self):
+        self._create("main.tex",
+                     "\\include{one}\n"
+                     "\\includegraphics{plot}\n")
+        self._create("one.tex", "\\graphicspath{{img}}")
+        self._create("img/plot.pdf", "PDF")
+
+        self._verify_same_as_sequential(is_speculative=False)
+
+    def test_chapters_that_break_the_main_document(self):
+        self._create("main.tex",
+                     "\\include{chap}\n"
+                     "\\includegraphics{\\fig{plot}}")
+        self._create("chap.tex", "\\def\\fig#1{img/#1}")
+        self._create("img/plot.pdf", "PDF")
+
+        self._verify_same_as_sequential(is_speculative=False)
+
+    def test_chapters_that_end_their_input(self):
+        self._create("main.tex",
+                     "\\include{chap}\n"
+                     "X\n")
+        self._create("chap.tex", "A\\endinput B")
+
+        self._verify_same_as_sequential(is_speculative=False)
+
+    def test_chapters_are_parsed_at_the_same_time(self):
+        self._create("main.tex",
+                     "\\include{one}\n"
+                     "\\include{two}\n")
+        self._create("one.tex", "One")
+        self._create("two.tex", "Two")
+
+        chapters = Barrier(2, timeout=5)
+        content_of = Run.content_of
+
+        def meet_other_chapter(run, location, invocation):
+            chapters.wait()
+            return content_of(run, location, invocation)
+
+        with patch.object(Run, "content_of", meet_other_chapter):
+            run, merged, _ = self._execute(speculative=True)
+
+        self.assertTrue(run.is_speculative)
+        self.assertEqual("One\\clearpage\nTwo\\clearpage\n", merged)
+
+
+class PreambleSnapshotTests(TestCase):
+
+    MAIN = ("\\documentclass{article}\n"
+            "\\usepackage{macros}\n"
+            "\\graphicspath{{img/}}\n"
+            "\\input{definitions}\n"
+            "\\begin{document}\n"
+            "\\title{Hello} \\includegraphics{plot}\n"
+            "\\end{document}\n")
+
+    def setUp(self):
+        self._file_system = InMemoryFileSystem()
+        self._create("main.tex", self.MAIN)
+        self._create("macros.sty", "\\RequirePackage{other}\n")
+        self._create("other.sty", "% Other package\n")
+        self._create("definitions.tex", "\\def\\title#1{\\textbf{#1}}\n")
+        self._create("img/plot.pdf", "PDF")
+
+    def _create(self, path, content):
+        self._file_system.create_file(Path.fromText("/project/" + path),
+                                      content)
+
+    def _execute(self, output, snapshot="/cache/preamble.json"):
+        display = MagicMock()
+        run = Settings(self._file_system,
+                       display,
+                       root_tex_file="/project/main.tex",
+                       output=output,
+                       snapshot=snapshot).execute()
+        directory = self._file_system.open(Path.fromText(output))
+        outputs = {each.fullname(): each.content()
+                   for each in directory.files()}
+        return run.count, outputs, display.entry.call_args_list
+
+    def _snapshot(self):
+        return self._file_system.open(
+            Path.fromText("/cache/preamble.json"))
+
+    def test_saves_the_state_reached_at_the_end_of_the_preamble(self):
+        expected = self._execute("/sequential", snapshot=None)
+
+        self.assertEqual(expected, self._execute("/first"))
+        self.assertFalse(self._snapshot().is_missing())
+
+    def test_restores_the_preamble_on_subsequent_runs(self):
+        expected = self._execute("/sequential", snapshot=None)
+        self._execute("/first")
+
+        with patch.object(Parser, "needs_rewriting",
+                          side_effect=Parser.needs_rewriting,
+                          autospec=True) as needs_rewriting:
+            actual = self._execute("/second")
+
+        self.assertEqual(expected, actual)
+        scanned = [each_call.args[1]
+                   for each_call in needs_rewriting.call_args_list]
+        self.assertNotIn("\\def\\title#1{\\textbf{#1}}\n", scanned)
+
+    def test_ignores_the_snapshot_once_an_input_changes(self):
+        self._execute("/first")
+        self._create("definitions.tex", "\\def\\title#1{\\emph{#1}}\n")
+
+        count, outputs, _ = self._execute("/second")
+
+        self.assertIn("\\emph{#1}", outputs["merged.tex"])
+
+    def test_ignores_a_snapshot_for_another_preamble(self):
+        self._execute("/first")
+        self._create("main.tex", self.MAIN.replace("img/", "figures/"))
+        self._create("figures/plot.pdf", "PDF")
+
+        count, outputs, _ = self._execute("/second")
+
+        self.assertIn("figures_plot.pdf", outputs)
+
+    def test_ignores_unreadable_snapshots(self):
+        expected = self._execute("/sequential", snapshot=None)
+        self._file_system.create_file(Path.fromText("/cache/preamble.json"),
+                                      "not JSON")
+
+        self.assertEqual(expected, self._execute("/first"))
+
+    def _verify_same_as_without_snapshot(self, main):
+        self._create("main.tex", main)
+        expected = self._execute("/sequential", snapshot=None)
+
+        self.assertEqual(expected, self._execute("/first"))
+        self.assertEqual(expected, self._execute("/second"))
+
+    def test_subfiles_roots(self):
+        self._verify_same_as_without_snapshot(
+            "\\documentclass[main.tex]{subfiles}\n"
+            "\\begin{document}\n"
+            "\\input{definitions}\n"
+            "\\end{document}\n")
+
+    def test_preambles_that_end_the_input(self):
+        self._verify_same_as_without_snapshot(
+            "\\documentclass{article}\n"
+            "\\input{definitions}\n"
+            "\\endinput\n"
+            "\\begin{document}\n"
+            "\\title{Ignored}\n"
+            "\\end{document}\n")
+
+    def test_begin_document_in_comments(self):
+        self._verify_same_as_without_snapshot(
+            "\\documentclass{article}\n"
+            "% \\begin{document}\n"
+            "\\input{definitions}\n"
+            "\\begin{document}\n"
+            "\\title{Hello}\n"
+            "\\end{document}\n")
+        self.assertFalse(self._snapshot().is_missing())
+
+    def test_begin_document_in_included_files(self):
+        self._create("start.tex", "\\input{definitions}\\begin{document}")
+        self._verify_same_as_without_snapshot(
+            "\\documentclass{article}\n"
+            "\\input{start}\n"
+            "\\title{Hello}\n"
+            "\\end{document}\n")
+        self.assertTrue(self._snapshot().is_missing())
+
+
+class TokenCacheTests(TestCase):
+
+    def setUp(self):
+        self._file_system = InMemoryFileSystem()
+        self._directory = TemporaryDirectory()
+        self._create("main.tex", "\\input{definitions}\n\\title{Hello}\n")
+        self._create("definitions.tex", "\\def\\title#1{\\textbf{#1}}\n")
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _create(self, path, content):
+        self._file_system.create_file(Path.fromText("/project/" + path),
+                                      content)
+
+    def _execute(self, output):
+        run = Settings(self._file_system,
+                       MagicMock(),
+                       root_tex_file="/project/main.tex",
+                       output=output,
+                       token_cache=self._directory.name).execute()
+        merged = self._file_system.open(Path.fromText(output + "/merged.tex"))
+        return run, merged.content()
+
+    def test_loads_the_tokens_lexed_by_previous_runs(self):
+        _, expected = self._execute("/first")
+        run, actual = self._execute("/second")
+
+        self.assertEqual(expected, actual)
+        self.assertEqual(1, run._tokens.loads)
+
+
+class LookaheadTests(TestCase):
+
+    def test_spots_inclusions(self):
+        self.assertEqual(
+            [("input", "macros"),
+             ("include", "chapters/one"),
+             ("subfile", "appendix.tex"),
+             ("includegraphics", "img/plot")],
+            Lookahead.targets(r"\input{macros} \include{chapters/one}"
+                              r"\subfile{appendix.tex}"
+                              r"\includegraphics[width=3cm]{img/plot}"))
+
+    def test_ignores_other_commands(self):
+        self.assertEqual([],
+                         Lookahead.targets(r"\inputenc{utf8} \cite{a}"))
+
+    def test_ignores_empty_links(self):
+        self.assertEqual([], Lookahead.targets(r"\input{ }"))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+#
+# This file is part of Flap.
+#
+# Flap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Flap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Flap.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from unittest import TestCase, main
+
+from flap.latex.parser import Factory
+from flap.latex.symbols import SymbolTable
+from flap.snapshot import PreambleSnapshot
+from flap.util.oofs import InMemoryFileSystem
+from flap.util.path import Path
+
+
+class PreambleSnapshotTest(TestCase):
+
+    PREAMBLE = "\\documentclass{article}\n\\begin{document}"
+    DOCUMENT = PREAMBLE + "\nHello\n\\end{document}\n"
+
+    def setUp(self):
+        self._factory = Factory(SymbolTable.default())
+        self._file_system = InMemoryFileSystem()
+        self._file_system.create_file(Path.fromText("/macros.tex"), "A")
+
+    def _snapshot(self):
+        snapshot = PreambleSnapshot()
+        snapshot.ends_at(self.DOCUMENT, len(self.PREAMBLE))
+        snapshot.read("/macros.tex", "A")
+        return snapshot
+
+    def test_holds_whatever_follows_the_preamble(self):
+        self.assertTrue(self._snapshot().holds(
+            self.PREAMBLE + "\nGoodbye\n", self._file_system))
+
+    def test_does_not_hold_for_a_shorter_document(self):
+        self.assertFalse(self._snapshot().holds(self.PREAMBLE[:-1],
+                                                self._file_system))
+
+    def test_encodes_tokens_back_and_forth(self):
+        tokens = self._factory.as_list("\\def\\x#1{Hello #1}% done\n")
+
+        encoded = PreambleSnapshot.encode(tokens)
+        decoded = PreambleSnapshot.decode(encoded, self._factory)
+
+        self.assertEqual(tokens, decoded)
+        self.assertEqual([each.location for each in tokens],
+                         [each.location for each in decoded])
+
+    def test_saves_and_loads(self):
+        snapshot = self._snapshot()
+        snapshot.rewriting = self.PREAMBLE
+
+        loaded = PreambleSnapshot.load(snapshot.save())
+
+        self.assertEqual(self.PREAMBLE, loaded.rewriting)
+        self.assertEqual(len(self.PREAMBLE), loaded.end)
+        self.assertTrue(loaded.holds(self.DOCUMENT, self._file_system))
+
+    def test_ignores_unreadable_text(self):
+        self.assertIsNone(PreambleSnapshot.load("{\"format\": 1}"))
+
+    def test_does_not_hold_for_another_preamble(self):
+        self.assertFalse(self._snapshot().holds(
+            self.DOCUMENT.replace("article", "book"), self._file_system))
+
+    def test_does_not_hold_once_an_input_changes(self):
+        self._file_system.create_file(Path.fromText("/macros.tex"), "B")
+        self.assertFalse(self._snapshot().holds(self.DOCUMENT,
+                                                self._file_system))
+
+
+if __name__ == "__main__":
+    main()
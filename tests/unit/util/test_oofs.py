@@ -17,8 +17,11 @@
 
 import unittest
 
-from flap.util.oofs import InMemoryFileSystem
-from flap.util.path import Path, ROOT
+from time import sleep
+
+from flap.util.oofs import ContentCache, InMemoryFileSystem, \
+    OSFileSystem
+from flap.util.path import Path, ROOT, TEMP
 
 
 class InMemoryFileSystemTest(unittest.TestCase):
@@ -133,5 +136,121 @@ class InMemoryFileSystemTest(unittest.TestCase):
         self.assertEqual(file.content(), "blahblah blah")
 
 
+class ContentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ContentCache(capacity=10)
+
+    def test_returns_contents_whose_signature_holds(self):
+        self.cache.put("a", (1, 3), "foo")
+        self.assertEqual("foo", self.cache.get("a", (1, 3)))
+        self.assertEqual(1, self.cache.hits)
+
+    def test_ignores_contents_whose_signature_changed(self):
+        self.cache.put("a", (1, 3), "foo")
+        self.assertIsNone(self.cache.get("a", (2, 3)))
+        self.assertEqual(1, self.cache.misses)
+
+    def test_caches_empty_contents(self):
+        self.cache.put("a", (1, 0), "")
+        self.assertEqual("", self.cache.get("a", (1, 0)))
+
+    def test_evicts_the_least_recently_used_contents(self):
+        self.cache.put("a", (1, 4), "aaaa")
+        self.cache.put("b", (1, 4), "bbbb")
+        self.cache.get("a", (1, 4))
+        self.cache.put("c", (1, 4), "cccc")
+
+        self.assertTrue(self.cache.holds("a", (1, 4)))
+        self.assertFalse(self.cache.holds("b", (1, 4)))
+        self.assertEqual(8, self.cache.size)
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_ignores_contents_larger_than_its_capacity(self):
+        self.cache.put("a", (1, 11), "a" * 11)
+        self.assertEqual(0, self.cache.size)
+
+
+class OSFileSystemCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fileSystem = OSFileSystem()
+        self.directory = TEMP / "flap_cache"
+        self.fileSystem.deleteDirectory(self.directory)
+        self.path = self.directory / "chapter.tex"
+        self.fileSystem.create_file(self.path, "Cached")
+
+    def tearDown(self):
+        self.fileSystem.deleteDirectory(self.directory)
+
+    def _prefetch(self, *paths):
+        for each_path in paths:
+            self.fileSystem.prefetch(each_path)
+        for _ in range(500):
+            if not self.fileSystem._prefetching:
+                return
+            sleep(0.01)
+        self.fail("Prefetching did not complete")
+
+    def _statistics(self):
+        return self.fileSystem.cache_statistics()
+
+    def test_files_opened_twice_are_read_once(self):
+        self.fileSystem.open(self.path).content()
+        self.fileSystem.open(self.path).content()
+
+        self.assertEqual(1, self._statistics()["hits"])
+        self.assertEqual(1, self._statistics()["misses"])
+
+    def test_empty_files_are_cached(self):
+        empty = self.directory / "empty.tex"
+        self.fileSystem.create_file(empty, "")
+        file = self.fileSystem.open(empty)
+
+        self.assertEqual("", file.content())
+        self.assertEqual("", file.content())
+        self.assertEqual(1, self._statistics()["misses"])
+
+    def test_files_changed_on_disk_are_read_again(self):
+        self.fileSystem.load(self.path)
+        with open(OSFileSystem.for_OS(self.path), "w") as file:
+            file.write("Changed since")
+
+        self.assertEqual("Changed since", self.fileSystem.load(self.path))
+
+    def test_prefetched_contents_are_cached(self):
+        other = self.directory / "other.tex"
+        self.fileSystem.create_file(other, "Prefetched")
+        self._prefetch(other)
+
+        self.assertEqual("Prefetched", self.fileSystem.load(other))
+        self.assertEqual(1, self._statistics()["hits"])
+
+    def test_prefetched_images_are_not_read(self):
+        image = self.directory / "plot.png"
+        self.fileSystem.create_file(image, "")
+        with open(OSFileSystem.for_OS(image), "wb") as file:
+            file.write(b"\x89PNG\r\n\x1a\n\xff\xfe")
+        drawing = self.directory / "plot.eps"
+        self.fileSystem.create_file(drawing, "%!PS-Adobe-3.0 EPSF-3.0")
+        self._prefetch(image, drawing)
+
+        self.assertEqual(0, self._statistics()["size"])
+        self.assertTrue(self.fileSystem.open(image).is_file())
+
+    def test_prefetched_stats_tell_files_from_directories(self):
+        self._prefetch(self.path, self.directory)
+
+        self.assertTrue(self.fileSystem.open(self.path).is_file())
+        self.assertFalse(self.fileSystem.open(self.directory).is_file())
+
+    def test_prefetching_missing_files(self):
+        missing = self.directory / "missing.tex"
+        self._prefetch(missing)
+
+        with self.assertRaises(FileNotFoundError):
+            self.fileSystem.load(missing)
+
+
 if __name__ == "__main__":
     unittest.main()